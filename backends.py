@@ -0,0 +1,131 @@
+import os
+import sys
+import csv
+import shutil
+import hashlib
+import tempfile
+import importlib
+import subprocess
+import numpy as np
+
+LOCAL_ENCODER = 'local-hashing-encoder'  # model_name of the offline stand-in sentence encoder
+
+
+class HashingEncoder:
+    """
+    Offline stand-in for sentence_transformers.SentenceTransformer, for tests and benchmarks without downloading models.
+    Each token gets a pseudo-random vector (seeded by its hash), mixed by a toy self-attention layer, and the sentence
+    embedding is the mean over its tokens. Batches are padded to their longest sentence, so, as in real transformers,
+    the cost of a batch grows with its padded length.
+    """
+
+    def __init__(self, dim=64):
+        self.dim = dim
+        self.token_vectors = {}
+
+    def token_vector(self, token):
+        if token not in self.token_vectors:
+            seed = int.from_bytes(hashlib.sha256(token.encode('utf-8')).digest()[:8], 'little')
+            self.token_vectors[token] = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return self.token_vectors[token]
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        embeds = []
+        for start in range(0, len(sentences), batch_size):
+            token_lists = [s.split() or [''] for s in sentences[start:start + batch_size]]
+            lengths = np.array([len(tokens) for tokens in token_lists])
+            padded = np.zeros([len(token_lists), lengths.max(), self.dim], dtype=np.float32)
+            for i, tokens in enumerate(token_lists):
+                padded[i, :len(tokens)] = [self.token_vector(t) for t in tokens]
+            mask = np.arange(lengths.max())[None, :] < lengths[:, None]  # [batch, max_len]
+
+            # toy self-attention over the padded batch
+            attention = padded @ padded.transpose(0, 2, 1) / np.sqrt(self.dim)  # [batch, max_len, max_len]
+            attention = np.where(mask[:, None, :], attention, -np.inf)
+            attention = np.exp(attention - attention.max(axis=-1, keepdims=True))
+            attention /= attention.sum(axis=-1, keepdims=True)
+            hidden = attention @ padded
+
+            embeds.append((hidden * mask[:, :, None]).sum(axis=1) / lengths[:, None])
+        return np.concatenate(embeds) if len(embeds) > 0 else np.zeros([0, self.dim], dtype=np.float32)
+
+
+def require(module_name, metric_name=''):
+    """
+    Import a heavy backend module on demand, so that metrics which do not use it never pay for its import.
+    :param module_name: e.g. 'bert_score'
+    :param metric_name: the metric requiring it, for the error message
+    :return: the module
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as e:
+        raise ImportError('[{}] is required by the {} metric but could not be imported ({}).'.format(
+            module_name, metric_name, e)) from e
+
+
+def load_bert_scorer(**kwargs):
+    return require('bert_score', 'BertScore').BERTScorer(**kwargs)
+
+
+def load_sentence_encoder(model_name):
+    if model_name == LOCAL_ENCODER:
+        return HashingEncoder()
+    return require('sentence_transformers', 'SentBert').SentenceTransformer(model_name)
+
+
+class BertStsScript:
+    """
+    Scores pairs with the bert-sts project (github.com/GuyTevet/bert-sts.git) inference script, which loads the model on
+    every run - hence BertSts sends it large batches. Each batch runs in a unique temp dir, without changing the
+    working directory of any process.
+    """
+
+    def __init__(self, sts_dir):
+        self.sts_dir = os.path.abspath(sts_dir)
+        if not os.path.isdir(self.sts_dir):
+            raise OSError('[{}] not found'.format(self.sts_dir))
+
+    def score(self, sentences_1, sentences_2):
+        run_dir = tempfile.mkdtemp(prefix='bert_sts_')
+        try:
+            out_fields = ['index', 'sentence1_id', 'sentence2_id', 'sentence1', 'sentence2']
+            with open(os.path.join(run_dir, 'test.tsv'), 'w') as f_out:
+                writer = csv.DictWriter(f_out, fieldnames=out_fields, dialect='excel-tab')
+                writer.writeheader()
+                for idx, (sentence_1, sentence_2) in enumerate(zip(sentences_1, sentences_2)):
+                    writer.writerow({'index': idx, 'sentence1_id': 0, 'sentence2_id': 0,
+                                     'sentence1': sentence_1, 'sentence2': sentence_2})
+
+            # stdout may be the output csv - the script logs go to stderr
+            subprocess.run(['bash', 'infer_sts.sh', '-i', run_dir, '-o', run_dir], cwd=self.sts_dir,
+                           stdout=sys.stderr, check=True)
+
+            with open(os.path.join(run_dir, 'test_results.tsv'), 'r') as results_f:
+                return [float(e) for e in results_f.read().split('\n')[:-1]]
+        finally:
+            shutil.rmtree(run_dir)
+
+
+class LexicalOverlapScorer:
+    """
+    Offline stand-in for bert-sts, for tests: 5 * the Jaccard similarity of the pair's word sets (the STS 0-5 scale).
+    """
+
+    def __init__(self, sts_dir=None):
+        pass
+
+    def score(self, sentences_1, sentences_2):
+        scores = []
+        for sentence_1, sentence_2 in zip(sentences_1, sentences_2):
+            words_1, words_2 = set(sentence_1.split()), set(sentence_2.split())
+            union = words_1 | words_2
+            scores.append(5. * len(words_1 & words_2) / len(union) if len(union) > 0 else 5.)
+        return scores
+
+
+STS_BACKENDS = {'bert-sts': BertStsScript, 'local': LexicalOverlapScorer}
+
+
+def load_sts_scorer(sts_backend, sts_dir):
+    return STS_BACKENDS[sts_backend](sts_dir)
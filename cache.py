@@ -0,0 +1,254 @@
+import os
+import csv
+import time
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+# locals
+import utils
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'diversity_eval_cache')
+DEFAULT_MAX_CACHE_BYTES = 10 * 2 ** 30
+DEFAULT_MAX_MEMORY_ITEMS = 16
+DEFAULT_MAX_SHARD_BYTES = 256 * 2 ** 20  # embeddings buffered in memory before an EmbeddingStore shard is written
+
+# config fields that do not affect the scores, hence are not part of the cache key
+VOLATILE_CONFIG_KEYS = ['input_path', 'cache_file', 'legacy_cache_file', 'cache_dir', 'max_cache_bytes',
+                        'ignore_cache', 'batch_size', 'max_batch_tokens', 'max_batch_size', 'length_bucketing',
+                        'pair_dedup', 'sts_dir', 'embedding_cache', 'sts_backend', 'lock_timeout']
+# config fields of the sampled pairs mode, which affect the scores only when it is on (sampled_pairs > 0)
+SAMPLED_PAIRS_CONFIG_KEYS = ['sampled_pairs', 'pair_sampling', 'seed']
+
+
+def score_config(config):
+    # the config fields that affect the scores, for cache keys and fingerprints
+    ignored = VOLATILE_CONFIG_KEYS + ([] if config.get('sampled_pairs', 0) > 0 else SAMPLED_PAIRS_CONFIG_KEYS)
+    return {k: v for k, v in config.items() if k not in ignored}
+
+
+def content_hash(csv_path, identity=''):
+    """
+    Hash the responses of a csv file (resp_i fields of all rows, in order) together with an identity string.
+    :param csv_path: input csv path
+    :param identity: str, e.g. the metric name, config and model
+    :return: hex digest
+    """
+    hasher = hashlib.sha256(identity.encode('utf-8'))
+    with open(csv_path, 'r+', encoding='utf-8') as f_in:
+        reader = csv.DictReader(f_in)
+        resp_keys = sorted([s for s in reader.fieldnames if
+                            s.startswith('resp_') and utils.represents_int(s.split('resp_')[-1])],
+                           key=lambda s: int(s.split('resp_')[-1]))
+        for row in reader:
+            hasher.update(('\x1f'.join([row[k] for k in resp_keys]) + '\x1e').encode('utf-8'))
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """
+    Size-bounded in-memory cache, evicting the least recently used item, with hit / miss counters.
+    """
+
+    def __init__(self, max_items=DEFAULT_MAX_MEMORY_ITEMS):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {'items': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+class DiskCache:
+    """
+    Size-bounded on-disk cache of score files, evicting the least recently used files, with hit / miss counters.
+    Recency is the files' modification time (updated on every hit), so it is shared by all the jobs using the same
+    cache dir. Files are written to a temp name and renamed into place, so concurrent jobs never read partial files.
+    The shards of the embedding stores under the cache dir count towards its size, and are evicted the same way.
+    """
+
+    file_suffix = '_scores.npy'
+    pairs_suffix = '_pairs.npy'  # the scored pairs of a scores file in the sampled pairs mode, evicted with it
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, path):
+        if not os.path.isfile(path):
+            self.misses += 1
+            return False
+        self.hits += 1
+        os.utime(path)  # mark as recently used
+        return True
+
+    def evict(self, cache_dir, max_bytes, keep=()):
+        # a scores file is evicted with its pairs file, and an embeddings shard with its keys file
+        cached_entries = [self.entry([path, self.pairs_path(path)]) for path in
+                          [os.path.join(cache_dir, file) for file in os.listdir(cache_dir)]
+                          if path.endswith(self.file_suffix) and path not in keep]
+        cached_entries += [self.entry(paths) for paths in EmbeddingStore.list_shards(cache_dir)]
+        cached_entries = [e for e in cached_entries if e is not None]
+        total_bytes = sum([e[1] for e in cached_entries]) + \
+            sum([os.path.getsize(p) for path in keep for p in [path, self.pairs_path(path)] if os.path.isfile(p)])
+        for _, size, paths in sorted(cached_entries):
+            if total_bytes <= max_bytes:
+                break
+            try:
+                os.remove(paths[0])
+                self.evictions += 1
+                for path in paths[1:]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    @staticmethod
+    def entry(paths):
+        # (last use time, total size, paths) of a cache entry - its main file first, None if evicted by another job
+        try:
+            mtime = os.stat(paths[0]).st_mtime
+        except FileNotFoundError:
+            return None
+        return mtime, sum([os.path.getsize(path) for path in paths if os.path.isfile(path)]), paths
+
+    def pairs_path(self, path):
+        return path[:-len(self.file_suffix)] + self.pairs_suffix
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class EmbeddingStore:
+    """
+    Persistent store of sentence embeddings, keyed by a hash of the sentence and the model name.
+    New embeddings are buffered in memory, and each flush (e.g. once per input file) appends them as a new shard
+    ([keys].npy + [embeds].npy files), so shards are never rewritten and concurrent runs never write to the same file.
+    Shards are evicted by DiskCache.evict, like the score files.
+    """
+
+    dir_prefix = 'embeddings_'
+    keys_suffix = '_keys.npy'
+    embeds_suffix = '_embeds.npy'
+
+    def __init__(self, cache_dir, model_name, max_shard_bytes=DEFAULT_MAX_SHARD_BYTES):
+        self.model_name = model_name
+        self.max_shard_bytes = max_shard_bytes
+        self.store_dir = os.path.join(cache_dir, '{}{}'.format(
+            self.dir_prefix, hashlib.sha256(model_name.encode('utf-8')).hexdigest()[:16]))
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.index = {}  # key -> (shard embeds path, row), with a None path for the buffered embeddings
+        self.pending_keys = []
+        self.pending_embeds = []
+        self.hits = 0
+        self.misses = 0
+
+        # read shards index - a shard is complete once its keys file exists
+        for keys_path, embeds_path in self.list_shards(cache_dir, self.store_dir):
+            try:
+                keys = np.load(keys_path)
+            except FileNotFoundError:  # evicted by another job
+                continue
+            self.index.update({key: (embeds_path, row) for row, key in enumerate(keys.tolist())})
+
+    @classmethod
+    def list_shards(cls, cache_dir, store_dir=None):
+        """
+        :param store_dir: a single store dir, or None for all the stores under cache_dir
+        :return: list of [keys path, embeds path] of the complete shards - a shard is complete once its keys file exists
+        """
+        store_dirs = [store_dir] if store_dir is not None else \
+            [os.path.join(cache_dir, e) for e in os.listdir(cache_dir) if e.startswith(cls.dir_prefix)]
+        shards = []
+        for store_dir in store_dirs:
+            for file in sorted(os.listdir(store_dir)) if os.path.isdir(store_dir) else []:
+                if file.endswith(cls.keys_suffix):
+                    shards.append([os.path.join(store_dir, file),
+                                   os.path.join(store_dir, file[:-len(cls.keys_suffix)] + cls.embeds_suffix)])
+        return shards
+
+    def key(self, sentence):
+        return hashlib.sha256((self.model_name + '\x1f' + sentence).encode('utf-8')).hexdigest()[:32]
+
+    def lookup(self, keys):
+        """
+        :param keys: list of keys
+        :return: list of embeddings, with None for keys not in the store
+        """
+        embeds = [None] * len(keys)
+        by_shard = {}
+        for i, key in enumerate(keys):
+            if key in self.index:
+                embeds_path, row = self.index[key]
+                if embeds_path is None:
+                    embeds[i] = self.pending_embeds[row]
+                else:
+                    by_shard.setdefault(embeds_path, []).append((i, row))
+        for embeds_path, positions in by_shard.items():
+            keys_path = embeds_path[:-len(self.embeds_suffix)] + self.keys_suffix
+            try:
+                shard = np.load(embeds_path, mmap_mode='r')
+                os.utime(keys_path)  # mark as recently used
+            except FileNotFoundError:  # evicted by another job
+                for i, _ in positions:
+                    self.index.pop(keys[i], None)
+                continue
+            for i, row in positions:
+                embeds[i] = np.array(shard[row])
+        num_missing = sum([e is None for e in embeds])
+        self.hits += len(keys) - num_missing
+        self.misses += num_missing
+        return embeds
+
+    def add(self, keys, embeds):
+        # buffer, a shard is written by flush (or once the buffer reaches max_shard_bytes)
+        for key, embed in zip(keys, np.asarray(embeds, dtype=np.float32)):
+            if key not in self.index:
+                self.index[key] = (None, len(self.pending_keys))
+                self.pending_keys.append(key)
+                self.pending_embeds.append(embed)
+        if len(self.pending_embeds) > 0 and \
+                len(self.pending_embeds) * self.pending_embeds[0].nbytes >= self.max_shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending_keys) == 0:
+            return
+        shard_name = '{:.6f}_{}'.format(time.time(), os.getpid())
+        embeds_path = os.path.join(self.store_dir, shard_name + self.embeds_suffix)
+        keys_path = os.path.join(self.store_dir, shard_name + self.keys_suffix)
+        np.save(embeds_path, np.stack(self.pending_embeds))
+        np.save(keys_path + '.tmp.npy', np.array(self.pending_keys, dtype='U32'))
+        os.replace(keys_path + '.tmp.npy', keys_path)  # marks the shard as complete
+        self.index.update({key: (embeds_path, row) for row, key in enumerate(self.pending_keys)})
+        self.pending_keys, self.pending_embeds = [], []
+
+    def stats(self):
+        return {'embeddings': len(self.index), 'hits': self.hits, 'misses': self.misses}
@@ -1,5 +1,4 @@
 from metrics_test import MetricsTest
-import matplotlib.pyplot as plt
 import os
 import numpy as np
 
@@ -7,6 +6,7 @@ import numpy as np
 import utils
 
 class ConTest(MetricsTest):
+    one_sided_scores = ['oca']  # always >= 0.5
 
     def __init__(self):
         super().__init__()
@@ -30,9 +30,24 @@ class ConTest(MetricsTest):
 
         return results
 
+    def bootstrap_scores(self, labels_vector, samples, indices):
+        scores = super().bootstrap_scores(labels_vector, samples, indices)
+        in_groups = (labels_vector == 1.) | (labels_vector == 0.)
+        scores['oca'] = utils.batch_optimal_classification_accuracy(
+            samples, labels_vector == 1., utils.index_counts(indices, len(samples)) * in_groups)
+        return scores
+
+    def permutation_scores(self, labels_vector, samples, permutations):
+        scores = super().permutation_scores(labels_vector, samples, permutations)
+        permuted_labels = labels_vector[permutations]
+        scores['oca'] = utils.batch_optimal_classification_accuracy(
+            samples, permuted_labels == 1., ((permuted_labels == 1.) | (permuted_labels == 0.)).astype(np.float64))
+        return scores
+
     def visualize(self, config, data, results):
         super().visualize(config, data, results)
         if config['publish_plots']:
+            import matplotlib.pyplot as plt
             for metric in results.keys():
                 fig, ax = plt.subplots()
                 labels_vector = data[utils.LABEL_VAL_FIELD]
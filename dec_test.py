@@ -1,5 +1,4 @@
 from metrics_test import MetricsTest
-import matplotlib.pyplot as plt
 import os
 import numpy as np
 
@@ -25,6 +24,7 @@ class DecTest(MetricsTest):
     def visualize(self, config, data, results):
         super().visualize(config, data, results)
         if config['publish_plots']:
+            import matplotlib.pyplot as plt
             for metric in results.keys():
                 fig, ax = plt.subplots()
                 stds_key = metric.replace('_mean', '') + '_std'
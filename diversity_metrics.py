@@ -1,26 +1,42 @@
 import os
-import shutil
-import subprocess
-import csv
-import bert_score
-import sentence_transformers
+import itertools
 import numpy as np
-from scipy.spatial.distance import cosine
 
 # locals
 import metric
+import cache
+import backends
 import similarity_metrics
 import utils
 
 class DistinctNgrams(metric.DiversityMetric):
+    """
+    online accumulator:
+        metric.reset()
+        for response in stream:
+            metric.update(response)
+        metric.value()  # distinct-n of all the responses so far
 
-    default_config = {'n': 3}
+        it keeps the unique n-grams and the n-grams count only - as tuples with the 'tuple' backend, and as stable
+        64-bit hashes with the 'hash' backend. With config['approx'] = True, the unique n-grams are counted by a
+        utils.HyperLogLog sketch of 2 ** config['hll_precision'] bytes instead, for unbounded streams.
+    """
+
+    default_config = {'n': 3, 'ngram_backend': 'tuple'}
 
     def __init__(self, config):
         super().__init__(config)
 
         # validate config
         self.uint_assert('n')
+        self.config.setdefault('ngram_backend', 'tuple')
+        assert self.config['ngram_backend'] in utils.NGRAM_BACKENDS
+        self.config.setdefault('approx', False)  # online accumulator only, see update
+        self.config.setdefault('hll_precision', 14)
+        assert type(self.config['approx']) == bool
+
+        self.token_hashes = {}  # token hashes cache of the online accumulator
+        self.reset()
 
     def normalized_unique_ngrams(self, ngram_lists):
         """
@@ -31,15 +47,110 @@ class DistinctNgrams(metric.DiversityMetric):
         ngrams = [item for sublist in ngram_lists for item in sublist]  # flatten
         return len(set(ngrams)) / len(ngrams) if len(ngrams) > 0 else 0.
 
+    def normalized_unique_hashed_ngrams(self, hashed_ngrams):
+        """
+        Same as normalized_unique_ngrams, for the 'hash' backend.
+        :param hashed_ngrams: uint64 array of all n-gram codes
+        :return: value in (0,1]
+        """
+        return len(np.unique(hashed_ngrams)) / len(hashed_ngrams) if len(hashed_ngrams) > 0 else 0.
+
+    def batch_normalized_unique_hashed_ngrams(self, hashed_ngrams, set_ids, num_sets):
+        """
+        Same as normalized_unique_hashed_ngrams, for the n-grams of many sets at once.
+        :param set_ids: int array with the set index of each n-gram
+        :return: [num_sets] array
+        """
+        inverse = utils.group_unique_inverse(hashed_ngrams, set_ids)
+        unique_set_ids = np.zeros(inverse.max() + 1 if len(inverse) > 0 else 0, dtype=np.int64)
+        unique_set_ids[inverse] = set_ids
+        num_unique = np.bincount(unique_set_ids, minlength=num_sets)
+        num_ngrams = np.bincount(set_ids, minlength=num_sets)
+        return np.divide(num_unique, num_ngrams, out=np.zeros(num_sets), where=num_ngrams > 0)
+
+    def tokenize(self, response_set):
+        return utils.tokenize(response_set, ngram_backend=self.config['ngram_backend'])
+
+    def tokenize_batch(self, response_sets):
+        token_lists = [self.tokenize(response_set) for response_set in response_sets]
+        if self.config['ngram_backend'] == 'hash':
+            return utils.concat_token_ids(token_lists)
+        return token_lists
+
+    def calc_from_tokens(self, token_lists, n):
+        if self.config['ngram_backend'] == 'hash':
+            hashed_ngrams, _ = utils.token_ids_to_hashed_ngrams(token_lists, n=n)
+            return self.normalized_unique_hashed_ngrams(hashed_ngrams)
+        return self.normalized_unique_ngrams(utils.tokens_to_ngrams(token_lists, n=n))
+
+    def calc_batch_from_tokens(self, batch_tokens, n):
+        if self.config['ngram_backend'] == 'hash':
+            # all the sets at once
+            hashed_ngrams, owners = utils.token_ids_to_hashed_ngrams(batch_tokens.token_ids, n=n)
+            return self.batch_normalized_unique_hashed_ngrams(hashed_ngrams, batch_tokens.set_ids[owners],
+                                                              batch_tokens.num_sets)
+        return np.array([self.calc_from_tokens(token_lists, n=n) for token_lists in batch_tokens], dtype=np.float64)
+
     def __call__(self, response_set):
         super().__call__(response_set)
-        return self.normalized_unique_ngrams(utils.lines_to_ngrams(response_set, n=self.config['n']))
+        return self.calc_from_tokens(self.tokenize(response_set), n=self.config['n'])
+
+    def score_batch(self, response_sets):
+        self.response_sets_assert(response_sets)
+        return self.calc_batch_from_tokens(self.tokenize_batch(response_sets), n=self.config['n'])
+
+    def reset(self):
+        # online accumulator state - the unique n-grams (or their HyperLogLog sketch) and the n-grams count so far
+        self.unique_ngrams = utils.HyperLogLog(self.config['hll_precision']) if self.config['approx'] else set()
+        self.num_ngrams = 0
+
+    def accumulator_tokens(self, responses):
+        # tokens for update_from_tokens - with stable token ids for hashed n-grams (the 'hash' backend or approx mode)
+        token_lists = utils.lines_to_tokens(responses)
+        if self.config['ngram_backend'] == 'hash' or self.config['approx']:
+            return utils.stable_token_ids(token_lists, self.token_hashes)
+        return token_lists
+
+    def update_from_tokens(self, tokens):
+        if isinstance(tokens, utils.TokenIds):
+            hashed_ngrams, _ = utils.token_ids_to_hashed_ngrams(tokens, n=self.config['n'])
+            self.unique_ngrams.update(hashed_ngrams if self.config['approx'] else hashed_ngrams.tolist())
+            self.num_ngrams += len(hashed_ngrams)
+        else:
+            for ngrams in utils.tokens_to_ngrams(tokens, n=self.config['n']):
+                self.unique_ngrams.update(ngrams)
+                self.num_ngrams += len(ngrams)
+
+    def update(self, responses):
+        """
+        Online accumulator - add responses (e.g. generations streamed from logs) to the running unique n-grams and
+        n-grams count, without keeping them.
+        :param responses: a response (string) or a list of responses
+        """
+        self.update_from_tokens(self.accumulator_tokens([responses] if type(responses) == str else responses))
+
+    def merge(self, other):
+        # add the accumulator state of another instance with the same config (e.g. per model -> corpus level)
+        if self.config['approx']:
+            self.unique_ngrams.merge(other.unique_ngrams)
+        else:
+            self.unique_ngrams |= other.unique_ngrams
+        self.num_ngrams += other.num_ngrams
+
+    def value(self):
+        """
+        :return: the distinct-n of all the responses added since reset() - as self(responses) of all of them at once
+        """
+        if self.num_ngrams == 0:
+            return 0.
+        num_unique = self.unique_ngrams.count() if self.config['approx'] else len(self.unique_ngrams)
+        return min(num_unique / self.num_ngrams, 1.)
 
 
 class AveragedDistinctNgrams(metric.AveragedNgramDiversityMetric):
 
     use_me = True
-    default_config = {'n_min': 1, 'n_max': 5}
+    default_config = {'n_min': 1, 'n_max': 5, 'ngram_backend': 'tuple'}
 
     def __init__(self, config):
         super().__init__(config, DistinctNgrams)
@@ -47,16 +158,34 @@ class AveragedDistinctNgrams(metric.AveragedNgramDiversityMetric):
 
 class CosineSimilarity2Diversity(metric.Similarity2DiversityMetric):
 
-    default_config = {'n': 3}
+    default_config = dict({'n': 3, 'ngram_backend': 'tuple'}, **metric.SAMPLED_PAIRS_CONFIG)
 
     def __init__(self, config):
         super().__init__(config, similarity_metrics.CosineSimilarity)
 
+    def tokenize(self, response_set):
+        return self.similarity_metric.tokenize(response_set)
+
+    def calc_from_tokens(self, token_lists, n):
+        similarity_list = self.similarity_metric.pairwise_similarities_from_tokens(token_lists, n=n)
+        return metric.similarity2diversity_function(similarity_list)
+
+    def tokenize_batch(self, response_sets):
+        return self.similarity_metric.tokenize_batch(response_sets)
+
+    def calc_batch_from_tokens(self, batch_tokens, n):
+        return np.array([metric.similarity2diversity_function(similarity_list) for similarity_list in
+                         self.similarity_metric.batch_pairwise_similarities_from_tokens(batch_tokens, n=n)],
+                        dtype=np.float64)
+
+    def pair_similarities_from_tokens(self, token_lists, rows, cols, n):
+        return self.similarity_metric.pair_similarities_from_tokens(token_lists, rows, cols, n=n)
+
 
 class AveragedCosineSimilarity(metric.AveragedNgramDiversityMetric):
 
     use_me = True
-    default_config = {'n_min': 1, 'n_max': 5}
+    default_config = dict({'n_min': 1, 'n_max': 5, 'ngram_backend': 'tuple'}, **metric.SAMPLED_PAIRS_CONFIG)
 
     def __init__(self, config):
         super().__init__(config, CosineSimilarity2Diversity)
@@ -65,120 +194,159 @@ class AveragedCosineSimilarity(metric.AveragedNgramDiversityMetric):
 class BertScore(metric.Similarity2DiversityFromFileMetric):
 
     use_me = True
+    model_name = 'bert_score:en:rescaled'
+    backend_modules = ['bert_score']
+    symmetric = True  # F1 of (a, b) == F1 of (b, a)
+    identical_similarity = 1.  # rescaled F1 of a sentence with itself
+    default_config = dict(metric.Similarity2DiversityFromFileMetric.default_config,
+                          batch_size=metric.DEFAULT_PAIRS_BATCH_SIZE,  # pairs read from the input at once
+                          length_bucketing=True,  # model batches of similar length pairs, see length_bucketed_map
+                          max_batch_tokens=metric.DEFAULT_MAX_BATCH_TOKENS,
+                          max_batch_size=metric.DEFAULT_MAX_BATCH_SIZE)
 
     def __init__(self, config):
         super().__init__(config)
+        self.scorer = None  # loaded on first use
 
-    def calc_scores(self):
-        super().calc_scores()
+    def score_pairs(self, refs, cands):
+        if self.scorer is None:
+            self.scorer = backends.load_bert_scorer(idf=False, lang='en', rescale_with_baseline=True)
 
-        # write input_tsv
-        self.create_input_tsv()
+        def score_batch(pairs):
+            P, R, F = self.scorer.score([cand for _, cand in pairs], [ref for ref, _ in pairs], batch_size=len(pairs))
+            return F.tolist()
 
-        # read data
-        with open(self.config['input_tsv'], 'r+', encoding='utf-8') as f_in:
-            cands = []
-            refs = []
-            reader = csv.DictReader(f_in, dialect='excel-tab')  # tsv reader
-            for row in reader:
-                refs.append(row['sentence1'])
-                cands.append(row['sentence2'])
+        pairs = list(zip(refs, cands))
+        lengths = [utils.num_tokens(ref) + utils.num_tokens(cand) for ref, cand in pairs]
+        return self.length_bucketed_map(score_batch, pairs, lengths)
 
-        # calc scores
-        P, R, F = bert_score.score(cands, refs, idf=False, lang='en', rescale_with_baseline=True)
+    def calc_scores(self):
+        super().calc_scores()
 
-        # write scores
-        output_str = '\n'.join(['{:.5f}'.format(e) for e in F.tolist()]) + '\n'
-        with open(self.config['cache_file'], 'w', encoding='utf-8') as f_out:
-            f_out.write(output_str)
+        # stream pairs from the input csv, and write scores as they come
+        self.calc_pair_scores(self.score_pairs)
 
 
 class BertSts(metric.Similarity2DiversityFromFileMetric):
 
     use_me = True
+    model_name = 'bert-sts'
+    default_config = dict(metric.Similarity2DiversityFromFileMetric.default_config,
+                          sts_backend='bert-sts',  # 'local' for an offline stand-in scorer, see backends.STS_BACKENDS
+                          sts_dir=os.path.join('..', 'bert-sts'),  # FIXME - hard coded
+                          # pairs per bert-sts script run (and checkpoint). Each run loads the model (~30 sec), which
+                          # is small next to scoring 50k pairs, while an interruption loses at most one batch
+                          batch_size=50000)
 
     def __init__(self, config):
+        config.setdefault('sts_backend', 'bert-sts')
+        config.setdefault('sts_dir', os.path.join('..', 'bert-sts'))
+        assert config['sts_backend'] in backends.STS_BACKENDS, 'unknown sts_backend [{}]'.format(config['sts_backend'])
+        if config['sts_backend'] != 'bert-sts':
+            self.model_name = config['sts_backend']  # sts_backend is volatile, the stand-in's scores are cached apart
         super().__init__(config)
+        self.sts_scorer = None  # loaded on first use
+
+    def score_pairs(self, sentences_1, sentences_2):
+        if self.sts_scorer is None:
+            self.sts_scorer = backends.load_sts_scorer(self.config['sts_backend'], self.config['sts_dir'])
+        return self.sts_scorer.score(sentences_1, sentences_2)
 
     def calc_scores(self):
         super().calc_scores()
 
-        # write input_tsv
-        self.create_input_tsv()
-
-        sts_dir_path = os.path.join('..', 'bert-sts') # FIXME - hard coded
-        if not os.path.isdir(sts_dir_path):
-            raise OSError('[{}] not found'.format(sts_dir_path))
-
-        # inits
-        run_dir = 'tmp_run'
-        abs_input_tsv = os.path.abspath(self.config['input_tsv'])
-        abs_output_tsv = os.path.abspath(self.config['cache_file'])
+        # stream pairs from the input csv to the bert-sts scorer in checkpointed batches
+        self.calc_pair_scores(self.score_pairs)
 
-        # move to sts dir
-        cur_dir = os.getcwd()
-        os.chdir(sts_dir_path)
-
-        # create the test dir
-        if os.path.isdir(run_dir):
-            shutil.rmtree(run_dir)
-        os.mkdir('tmp_run')
-        shutil.copy(abs_input_tsv, os.path.join(run_dir, 'test.tsv'))
-
-        # run bert-sts
-        subprocess.run(['bash', 'infer_sts.sh', '-i', run_dir, '-o', run_dir])
-
-        # copy back results
-        shutil.copy(os.path.join(run_dir, 'test_results.tsv'), abs_output_tsv)
-
-        # return to current dir
-        shutil.rmtree(run_dir)
-        os.chdir(cur_dir)
 
 class SentBert(metric.Similarity2DiversityFromFileMetric):
 
     use_me = True
+    model_name = 'bert-large-nli-stsb-mean-tokens'
+    backend_modules = ['sentence_transformers']
+    default_config = dict(metric.Similarity2DiversityFromFileMetric.default_config,
+                          batch_size=metric.DEFAULT_PAIRS_BATCH_SIZE,  # pairs (of whole sets) per checkpoint
+                          model_name=model_name,  # backends.LOCAL_ENCODER for an offline stand-in encoder
+                          embedding_cache=True,  # persistent per-sentence embeddings store, under cache_dir
+                          length_bucketing=True,  # model batches of similar length sentences, see length_bucketed_map
+                          max_batch_tokens=metric.DEFAULT_MAX_BATCH_TOKENS,
+                          max_batch_size=metric.DEFAULT_MAX_BATCH_SIZE)
 
     def __init__(self, config):
+        config.setdefault('model_name', self.model_name)
         super().__init__(config)
-        self.similarity_metric = lambda vector_a, vector_b: 1 - cosine(vector_a, vector_b)
+        self.model = None  # loaded on first use
+        self.embedding_store = None
+
+    def load_backends(self):
+        if self.config['model_name'] != backends.LOCAL_ENCODER:
+            super().load_backends()
+
+    def encode(self, resp_list):
+        """
+        Encode each unique response once, reading and writing the embeddings store if enabled.
+        :param resp_list: list of strings
+        :return: [len(resp_list), embed_dim] embeddings
+        """
+        unique_resps = list(dict.fromkeys(resp_list))
+        store = None
+        unique_embeds = [None] * len(unique_resps)
+        if self.config.get('embedding_cache', False):
+            if self.embedding_store is None:
+                self.embedding_store = cache.EmbeddingStore(self.config['cache_dir'], self.config['model_name'])
+            store = self.embedding_store
+            unique_embeds = store.lookup([store.key(resp) for resp in unique_resps])
+
+        # encode missing responses only
+        missing = [i for i, embed in enumerate(unique_embeds) if embed is None]
+        if len(missing) > 0:
+            if self.model is None:
+                self.model = backends.load_sentence_encoder(self.config['model_name'])
+            model = self.model
+            missing_resps = [unique_resps[i] for i in missing]
+            missing_embeds = np.array(self.length_bucketed_map(lambda batch: model.encode(batch, batch_size=len(batch)),
+                                                               missing_resps,
+                                                               [utils.num_tokens(resp) for resp in missing_resps]))
+            for i, embed in zip(missing, missing_embeds):
+                unique_embeds[i] = embed
+            if store is not None:
+                store.add([store.key(unique_resps[i]) for i in missing], missing_embeds)
+
+        resp_to_idx = {resp: i for i, resp in enumerate(unique_resps)}
+        return np.array(unique_embeds)[[resp_to_idx[resp] for resp in resp_list]]
 
     def calc_scores(self):
         super().calc_scores()
 
-        # write input_tsv
-        model_name = 'bert-large-nli-stsb-mean-tokens' # FIXME - hard coded
-        model = sentence_transformers.SentenceTransformer(model_name)
-        resp_list = []
-
-        # read resps
-        with open(self.config['input_path'], 'r+', encoding='utf-8') as f_in:
-            reader = csv.DictReader(f_in)
-            resp_keys = sorted([s for s in reader.fieldnames if
-                                s.startswith('resp_') and utils.represents_int(s.split('resp_')[-1])])
-            for row in reader:
-                resps = [v for k, v in row.items() if k in resp_keys]
-                resp_list += resps
-
-        # calc embeds
-        embeds = np.array(model.encode(resp_list)) # [ num_contexts * samples_per_context, embed_dim]
-        assert len(embeds.shape) == 2
-        assert embeds.shape[0] == self.config['num_sets'] * self.config['samples_per_set']
-        embeds = np.reshape(embeds, [self.config['num_sets'], self.config['samples_per_set'], -1])
-
-        # write a cache file compatible with the ordering in bert_score and bert_sts
-        similarity_scores_list = [] # note: len() assertion are done in get_similarity_scores method
-        for set_i in range(self.config['num_sets']):
-            for sample_i in range(self.config['samples_per_set']):
-                for sample_j in range(sample_i):
-                    similarity_scores_list.append(self.similarity_metric(
-                        embeds[set_i, sample_i, :], embeds[set_i, sample_j, :]))
-        with open(self.config['cache_file'], 'w') as cache_f:
-            for score in similarity_scores_list:
-                cache_f.write('{:0.3f}\n'.format(score))
-
-        # # write results
-        # np.save(self.config['cache_file'], embeds)
+        # calc scores in chunks of sets, each chunk is checkpointed
+        with metric.ScoresCheckpoint(self.config, self.pairs_per_set) as checkpoint:
+            if checkpoint.done:  # calculated by another job meanwhile
+                return
+            # sets without pairs (a single sample per set) have no scores, and are all skipped
+            num_scored_sets = checkpoint.num_scored // self.pairs_per_set if self.pairs_per_set > 0 else \
+                self.config['num_sets']
+            response_sets = itertools.islice(self.iter_response_sets(), num_scored_sets, None)
+            sets_per_chunk = max(1, self.config.get('batch_size', metric.DEFAULT_PAIRS_BATCH_SIZE) //
+                                 max(self.pairs_per_set, 1))
+            rows, cols = np.tril_indices(self.config['samples_per_set'], -1)
+            for chunk in utils.batched(response_sets, sets_per_chunk):
+
+                # calc embeds
+                embeds = self.encode([resp for response_set in chunk for resp in response_set])
+                embeds = np.reshape(embeds, [len(chunk), self.config['samples_per_set'], -1])
+
+                # cosine similarities of all the pairs in each set at once
+                embeds = embeds / np.linalg.norm(embeds, axis=-1, keepdims=True)
+                similarity_matrices = embeds @ embeds.transpose(0, 2, 1)  # [sets, samples_per_set, samples_per_set]
+
+                # write scores compatible with the ordering in bert_score and bert_sts ((i, j), j < i) of the pairs
+                if self.sampled:
+                    pairs = [self.sample_pairs(response_set) for response_set in chunk]
+                    rows, cols = np.stack([i for i, _ in pairs]), np.stack([j for _, j in pairs])
+                checkpoint.write(similarity_matrices[np.arange(len(chunk))[:, None], rows, cols].reshape(-1))
+            checkpoint.finish()
+        if self.embedding_store is not None:
+            self.embedding_store.flush()  # a single shard of the new embeddings of this file
 
 
 if __name__ == '__main__':
@@ -195,3 +363,10 @@ if __name__ == '__main__':
     avg_config = {'n_min': 1, 'n_max': 5}
     print_metric(AveragedCosineSimilarity(avg_config), resp_set)
     print_metric(AveragedDistinctNgrams(avg_config), resp_set)
+
+    # online accumulator
+    for approx in [False, True]:
+        accumulator = AveragedDistinctNgrams(dict(avg_config, approx=approx))
+        for resp in resp_set:
+            accumulator.update(resp)
+        print('AveragedDistinctNgrams online (approx={0}): {1:0.3f}'.format(approx, accumulator.value()))
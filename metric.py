@@ -2,18 +2,52 @@ from abc import ABC, abstractmethod
 import numpy as np
 import tempfile
 import os
+import sys
 import csv
+import json
+import hashlib
+import itertools
+import socket
+import time
 
 # locals
 import utils
-
-global_score_cache = {}
+import cache
+import backends
+
+global_score_cache = cache.LRUCache()  # in memory, keyed by cache file
+global_disk_cache = cache.DiskCache()
+DEFAULT_PAIRS_BATCH_SIZE = 4096  # pairs sent at once to a scorer by calc_pair_scores
+DEFAULT_MAX_BATCH_TOKENS = 4096  # padded size budget of a neural model batch, see length_bucketed_map
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_LOCK_TIMEOUT_SEC = 24 * 60 * 60  # how long a job waits for another job calculating the same scores file
+LOCK_POLL_SEC = 5
 similarity2diversity_function = lambda sim_score_list: - np.mean(sim_score_list)
+# config of the sampled pairs mode of the pairwise similarity metrics - estimate the diversity of each set from a sample
+# of its pairs, with a standard error (see DiversityMetric.score_batch_with_se)
+SAMPLED_PAIRS_CONFIG = {'sampled_pairs': 0,  # pairs scored per set, 0 for all the pairs (exact scores)
+                        'pair_sampling': 'random',  # one of utils.PAIR_SAMPLINGS
+                        'seed': 0}
+
+
+def similarities2diversity_with_se(similarity_lists, set_sizes):
+    """
+    Diversity estimates of sets from the similarities of their sampled pairs, and the estimates' standard errors.
+    :param similarity_lists: list of similarity lists, one per set
+    :param set_sizes: list of the number of responses in each set
+    :return: ([num_sets] diversity scores, [num_sets] standard errors)
+    """
+    scores = np.array([similarity2diversity_function(e) for e in similarity_lists], dtype=np.float64)
+    standard_errors = np.array([utils.mean_standard_error(e, utils.num_pairs(size))
+                                for e, size in zip(similarity_lists, set_sizes)], dtype=np.float64)
+    return scores, standard_errors
 
 
 class Metric(ABC):
     use_me = False  # static var indicates to run files whether or not to use this metric
     default_config = {}  # static var, specifies the default config for run files
+    backend_modules = []  # static var, heavy modules this metric needs - imported on instantiation, not on import
+    version = 1  # static var, bump it when a change to the metric changes its scores (see fingerprint)
 
     def __init__(self, config):
         self.config = config
@@ -21,6 +55,22 @@ class Metric(ABC):
         # validate config
         assert type(self.config) == dict, 'Metric config must be dict type.'
 
+        self.load_backends()
+
+    def load_backends(self):
+        for module_name in self.backend_modules:
+            backends.require(module_name, type(self).__name__)
+
+    @classmethod
+    def fingerprint(cls, config):
+        """
+        Identity of the metric scores - the metric name, version and the config fields that affect the scores.
+        :param config: metric config
+        :return: hex digest
+        """
+        identity = json.dumps([cls.__name__, cls.version, cache.score_config(config)], sort_keys=True, default=str)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
     @abstractmethod
     def __call__(self, *args, **kwargs):
         pass
@@ -37,6 +87,7 @@ class Metric(ABC):
 
 class DiversityMetric(Metric):
     required_input = 'response_set'  # in most cases, the diversity metric input is the response set S_c
+    pairwise = False  # static var, whether the metric scores pairs of responses (see num_scored_pairs)
 
     def __init__(self, config):
         super().__init__(config)
@@ -51,6 +102,54 @@ class DiversityMetric(Metric):
         diversity_score = None
         return diversity_score
 
+    def score_batch(self, inputs):
+        """
+        Score many inputs at once. Override it for metrics that can vectorize across sets.
+        :param inputs: list of inputs, each as in __call__ (e.g. response sets, or set indices for file metrics)
+        :return: [len(inputs)] numpy array of diversity scores
+        """
+        return np.array([self(e) for e in inputs], dtype=np.float64)
+
+    def score_batch_with_se(self, inputs):
+        """
+        Same as score_batch, with the standard error of each score. Override it for metrics that support the sampled
+        pairs mode (see SAMPLED_PAIRS_CONFIG).
+        :return: ([len(inputs)] scores, [len(inputs)] standard errors - 0. for exact scores)
+        """
+        scores = self.score_batch(inputs)
+        return scores, np.zeros(len(scores))
+
+    @property
+    def sampled(self):
+        return self.config.get('sampled_pairs', 0) > 0
+
+    def sampled_pairs_assert(self):
+        for field_name, value in SAMPLED_PAIRS_CONFIG.items():
+            self.config.setdefault(field_name, value)
+        assert type(self.config['sampled_pairs']) == int and self.config['sampled_pairs'] >= 0, \
+            'Required: sampled_pairs(int) >= 0'
+        assert self.config['pair_sampling'] in utils.PAIR_SAMPLINGS
+        assert type(self.config['seed']) == int
+
+    def num_scored_pairs(self, set_size):
+        # pairs scored for a set of set_size responses, 0 for metrics which do not score pairs
+        if not self.pairwise:
+            return 0
+        num_pairs = utils.num_pairs(set_size)
+        return min(self.config['sampled_pairs'], num_pairs) if self.sampled else num_pairs
+
+    def sample_pairs(self, response_set):
+        # the (i, j), j < i, pairs to score - all of them, or sampled_pairs pairs seeded by the responses
+        if not self.sampled:
+            return np.tril_indices(len(response_set), -1)
+        return utils.sample_pairs(len(response_set), self.config['sampled_pairs'],
+                                  utils.response_set_rng(response_set, self.config['seed']),
+                                  self.config['pair_sampling'])
+
+    def response_sets_assert(self, response_sets):
+        assert type(response_sets) == list
+        assert all([type(s) == list and all([type(e) == str for e in s]) for s in response_sets])
+
 
 class SimilarityMetric(Metric):
 
@@ -66,6 +165,32 @@ class SimilarityMetric(Metric):
         similarity_score = None
         return similarity_score
 
+    def pairwise_similarities(self, response_set):
+        """
+        Calc the similarity of every (i, j) pair, j < i, of a response set.
+        Override it for similarity metrics that can score a whole set at once.
+        :param response_set: list of strings
+        :return: list of choose(len(response_set), 2) similarity scores, ordered by (i, j)
+        """
+        return [self(response_set[i], response_set[j]) for i in range(len(response_set)) for j in range(i)]
+
+    def pair_similarities(self, response_set, rows, cols):
+        """
+        Calc the similarity of the given (i, j) pairs of a response set only, for the sampled pairs mode.
+        :param rows: i of each pair
+        :param cols: j of each pair
+        :return: list of similarity scores
+        """
+        return [self(response_set[i], response_set[j]) for i, j in zip(rows, cols)]
+
+    def batch_pairwise_similarities(self, response_sets):
+        """
+        Same as pairwise_similarities, for many response sets at once.
+        :param response_sets: list of response sets
+        :return: list of similarity lists, one per set
+        """
+        return [self.pairwise_similarities(response_set) for response_set in response_sets]
+
 
 class Similarity2DiversityMetric(DiversityMetric):
     """
@@ -80,6 +205,11 @@ class Similarity2DiversityMetric(DiversityMetric):
         metric = Similarity2DiversityMetric(config, SimilarityMetricClassName)
         metric(response_set)
 
+    sampled pairs mode:
+        with config['sampled_pairs'] > 0 (see SAMPLED_PAIRS_CONFIG), the scores are estimated from sampled_pairs pairs
+        per set, scored by the similarity metric's pair_similarities, and score_batch_with_se reports their standard
+        errors.
+
     inheritance guidelines:
         implement __init__ only
 
@@ -87,28 +217,268 @@ class Similarity2DiversityMetric(DiversityMetric):
         see CosineSimilarity2Diversity
     """
 
+    pairwise = True
+
     def __init__(self, config, similarity_metric_class):
         super().__init__(config)
         assert issubclass(similarity_metric_class, SimilarityMetric)
         self.similarity_metric = similarity_metric_class(config)
+        self.sampled_pairs_assert()
 
     def __call__(self, response_set):
         super().__call__(response_set)
+        if self.sampled:
+            return self.score_batch_with_se([response_set])[0][0]
 
-        similarity_list = []
-        for i in range(len(response_set)):
-            for j in range(i):
-                similarity_list.append(self.similarity_metric(response_set[i], response_set[j]))
+        similarity_list = self.similarity_metric.pairwise_similarities(response_set)
         diversity_score = similarity2diversity_function(similarity_list)
         return diversity_score
 
+    def score_batch(self, response_sets):
+        if self.sampled:
+            return self.score_batch_with_se(response_sets)[0]
+        self.response_sets_assert(response_sets)
+        return np.array([similarity2diversity_function(similarity_list) for similarity_list in
+                         self.similarity_metric.batch_pairwise_similarities(response_sets)], dtype=np.float64)
+
+    def score_batch_with_se(self, response_sets):
+        if not self.sampled:
+            return super().score_batch_with_se(response_sets)
+        self.response_sets_assert(response_sets)
+        similarity_lists = []
+        for response_set in response_sets:
+            responses, rows, cols = utils.pairs_responses(*self.sample_pairs(response_set))  # score these only
+            similarity_lists.append(self.similarity_metric.pair_similarities([response_set[i] for i in responses],
+                                                                             rows, cols))
+        return similarities2diversity_with_se(similarity_lists, [len(e) for e in response_sets])
+
+
+class ScoresCheckpoint:
+    """
+    Writes similarity scores chunk by chunk to a partial cache file, next to a progress manifest, so an interrupted
+    calc_scores can resume from the last completed chunk. The partial file is renamed to the cache file once all the
+    num_sets * pairs_per_set scores are written. The partial file is guarded by an exclusive lock file, so two jobs
+    never write the same partial file at once - a job waits for the lock (up to config['lock_timeout'] seconds), and
+    if the other job finished the cache file meanwhile, the checkpoint is done without calculating anything.
+
+    usage:
+        with ScoresCheckpoint(config, pairs_per_set) as checkpoint:
+            if not checkpoint.done:
+                # skip the first checkpoint.num_scored pairs, then for each chunk:
+                checkpoint.write(chunk_scores)
+                checkpoint.finish()
+    """
+
+    def __init__(self, config, pairs_per_set):
+        self.config = config
+        self.partial_file = config['cache_file'] + '.partial.npy'
+        self.manifest_file = config['cache_file'] + '.progress.json'
+        self.lock_file = config['cache_file'] + '.lock'
+        self.total = config['num_sets'] * pairs_per_set
+        self.num_scored = 0
+        cache_mtime = self.cache_mtime()  # an existing cache file is stale (e.g. its sampled pairs were evicted)
+        self.acquire_lock()
+        try:
+            # written by the job that held the lock
+            self.done = not config.get('ignore_cache', False) and self.cache_mtime() not in [None, cache_mtime]
+            if self.done:
+                self.release_lock()
+                return
+
+            # resume
+            shape = (config['num_sets'], pairs_per_set)
+            manifest = {}
+            if not config.get('ignore_cache', False) and os.path.isfile(self.manifest_file) \
+                    and os.path.isfile(self.partial_file):
+                with open(self.manifest_file, 'r') as manifest_f:
+                    manifest = json.load(manifest_f)
+            if manifest.get('total', None) == self.total:
+                self.scores = np.lib.format.open_memmap(self.partial_file, mode='r+')
+                assert self.scores.shape == shape, '[{}] does not match num_sets.'.format(self.partial_file)
+                self.num_scored = manifest['num_scored']
+                print('Resuming [{}] from {}/{} scores.'.format(config['input_path'], self.num_scored, self.total),
+                      file=sys.stderr)  # stdout may be the output csv
+            else:
+                self.scores = np.lib.format.open_memmap(self.partial_file, mode='w+', dtype=np.float32, shape=shape)
+                self.save_manifest()
+            self.flat_scores = self.scores.reshape(-1)
+        except BaseException:
+            self.release_lock()  # __exit__ is not called when __init__ fails
+            raise
+
+    def __enter__(self):
+        return self
+
+    def cache_mtime(self):
+        try:
+            return os.path.getmtime(self.config['cache_file'])
+        except FileNotFoundError:
+            return None
+
+    def __exit__(self, *exc_info):
+        self.release_lock()  # an unfinished partial file is kept, to be resumed
+
+    def acquire_lock(self):
+        """
+        Create the lock file exclusively (O_EXCL), polling while another job holds it. A lock left by a process that is
+        no longer running on this host (e.g. a killed job) is taken over, as its partial file is safe to resume.
+        """
+        owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        deadline = time.time() + self.config.get('lock_timeout', DEFAULT_LOCK_TIMEOUT_SEC)
+        waiting = False
+        while True:
+            try:
+                lock_fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(self.lock_file, 'r') as lock_f:
+                        lock_owner = lock_f.read()
+                except FileNotFoundError:  # released meanwhile
+                    continue
+                if not self.is_stale_lock(lock_owner):
+                    if time.time() > deadline:
+                        raise RuntimeError('[{}] is being calculated by another job ({}) for too long, remove [{}] if '
+                                           'it is not running.'.format(self.config['cache_file'], lock_owner,
+                                                                       self.lock_file))
+                    if not waiting:
+                        print('Waiting for [{}], being calculated by another job ({}).'.format(
+                            self.config['input_path'], lock_owner), file=sys.stderr)
+                        waiting = True
+                    time.sleep(LOCK_POLL_SEC)
+                    continue
+                try:
+                    os.remove(self.lock_file)
+                except FileNotFoundError:  # taken over by another job
+                    pass
+                continue
+            with os.fdopen(lock_fd, 'w') as lock_f:
+                lock_f.write(owner)
+            self.lock_owner = owner
+            return
+
+    @staticmethod
+    def is_stale_lock(lock_owner):
+        host, _, pid = lock_owner.rpartition(':')
+        if host != socket.gethostname() or not pid.isdigit():
+            return False  # can't tell, or the lock is being written
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:  # running, as another user
+            pass
+        return False
+
+    def release_lock(self):
+        if getattr(self, 'lock_owner', None) is None:
+            return
+        try:
+            with open(self.lock_file, 'r') as lock_f:
+                if lock_f.read() == self.lock_owner:
+                    os.remove(self.lock_file)
+        except FileNotFoundError:
+            pass
+        self.lock_owner = None
+
+    def save_manifest(self):
+        tmp_file = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+        with open(tmp_file, 'w') as manifest_f:
+            json.dump({'input_path': self.config['input_path'], 'num_scored': self.num_scored, 'total': self.total},
+                      manifest_f)
+        os.replace(tmp_file, self.manifest_file)
+
+    def write(self, scores):
+        self.flat_scores[self.num_scored:self.num_scored + len(scores)] = scores
+        self.num_scored += len(scores)
+        self.scores.flush()
+        self.save_manifest()  # only after the scores are on disk
+
+    def finish(self):
+        assert self.num_scored == self.total, \
+            '[{}] has {} scores, expected {}.'.format(self.config['input_path'], self.num_scored, self.total)
+        del self.flat_scores, self.scores
+        # the cache file may already exist (e.g. written by a job on another host), it is replaced by the same scores
+        os.replace(self.partial_file, self.config['cache_file'])
+        try:
+            os.remove(self.manifest_file)
+        except FileNotFoundError:
+            pass
+        self.release_lock()
+
+
+class PairDeduplicator:
+    """
+    Maps sentence pairs to unique pairs, so that each unique pair is scored once across all the sets (and batches) of
+    an input file. Pairs of symmetric metrics are canonicalized (sorted), and pairs of identical (non-empty) sentences
+    get identical_similarity without scoring, if the metric defines one.
+
+    usage:
+        dedup = PairDeduplicator(symmetric, identical_similarity)
+        rows, new_pairs = dedup.index(sentences_1, sentences_2)
+        dedup.add_scores(score_pairs(*zip(*new_pairs)))
+        scores = dedup.gather(rows)
+    """
+
+    def __init__(self, symmetric=False, identical_similarity=None):
+        self.symmetric = symmetric
+        self.identical_similarity = identical_similarity
+        self.rows = {}  # pair digest -> unique pair index
+        self.scores = []  # unique pair index -> score
+        self.num_pairs = 0
+        self.num_identical = 0
+
+    def key(self, sentence_1, sentence_2):
+        if self.symmetric and sentence_2 < sentence_1:
+            sentence_1, sentence_2 = sentence_2, sentence_1
+        return hashlib.sha256((sentence_1 + '\x1f' + sentence_2).encode('utf-8')).digest()[:16]
+
+    def index(self, sentences_1, sentences_2):
+        """
+        :return: (rows, new_pairs) - rows: the unique pair index of each pair (-1 for identical sentences),
+                 new_pairs: list of (sentence 1, sentence 2) of the unique pairs first seen in this call, in index order
+        """
+        rows = []
+        new_pairs = []
+        for sentence_1, sentence_2 in zip(sentences_1, sentences_2):
+            if self.identical_similarity is not None and sentence_1 == sentence_2 and sentence_1.strip() != '':
+                rows.append(-1)
+                self.num_identical += 1
+                continue
+            key = self.key(sentence_1, sentence_2)
+            if key not in self.rows:
+                self.rows[key] = len(self.rows)
+                new_pairs.append((sentence_1, sentence_2))
+            rows.append(self.rows[key])
+        self.num_pairs += len(rows)
+        return rows, new_pairs
+
+    def add_scores(self, scores):
+        self.scores.extend(scores)
+        assert len(self.scores) <= len(self.rows)
+
+    def gather(self, rows):
+        # scatter the unique pairs' scores back to the pairs' order
+        return [self.identical_similarity if row < 0 else self.scores[row] for row in rows]
+
+    def stats(self):
+        return {'pairs': self.num_pairs, 'unique_pairs': len(self.rows), 'identical_pairs': self.num_identical,
+                'dedup_ratio': 1. - len(self.rows) / self.num_pairs if self.num_pairs > 0 else 0.}
+
 
 class Similarity2DiversityFromFileMetric(DiversityMetric):
     required_input = 'set_index'  # when reading results from a file, the input is the set index
+    pairwise = True
+    model_name = None  # identity of the underlying model, part of the cache key
+    symmetric = False  # static var, whether score(a, b) == score(b, a), see PairDeduplicator
+    identical_similarity = None  # static var, the score of a pair of identical sentences, if the model guarantees one
 
     default_config = {'input_path': None,
                       'num_sets': -1,
-                      'samples_per_set': -1}  # required fields - filled by run files
+                      'samples_per_set': -1,  # required fields - filled by run files
+                      'cache_dir': None,  # None for cache.DEFAULT_CACHE_DIR
+                      'max_cache_bytes': cache.DEFAULT_MAX_CACHE_BYTES,
+                      'pair_dedup': True,  # score each unique pair once, see PairDeduplicator
+                      **SAMPLED_PAIRS_CONFIG}
 
     def __init__(self, config):
         super().__init__(config)
@@ -117,64 +487,177 @@ class Similarity2DiversityFromFileMetric(DiversityMetric):
         self.uint_assert('num_sets')
         self.uint_assert('samples_per_set')
         self.input_path_assert('input_path')
+        self.sampled_pairs_assert()
 
-        # define cache
+        # define cache - a binary [num_sets, pairs_per_set] .npy file (see save_similarity_scores), keyed by the
+        # responses, the metric config and the model, so it can be safely shared by files and jobs
         metric_name = utils.CamleCase2snake_case(type(self).__name__)
-        self.config['cache_file'] = os.path.join(tempfile.gettempdir(),
-                                                 os.path.basename(self.config['input_path']
-                                                                  .replace('.csv',
-                                                                           '_{}_scores.tsv'.format(metric_name))))
-        self.config['input_tsv'] = os.path.join(tempfile.gettempdir(),
-                                                os.path.basename(self.config['input_path']
-                                                                 .replace('.csv', '_{}_input.tsv'.format(metric_name))))
+        self.config['cache_dir'] = self.config.get('cache_dir', None) or cache.DEFAULT_CACHE_DIR
+        self.config.setdefault('max_cache_bytes', cache.DEFAULT_MAX_CACHE_BYTES)
+        self.config.setdefault('pair_dedup', True)
+        self.pair_stats = None  # PairDeduplicator.stats() of the last calc_pair_scores
+        os.makedirs(self.config['cache_dir'], exist_ok=True)
+        self.cache_key = self.get_cache_key()
+        self.config['cache_file'] = os.path.join(self.config['cache_dir'],
+                                                 '{}_{}{}'.format(metric_name, self.cache_key,
+                                                                  cache.DiskCache.file_suffix))
+
+        # text cache of older versions, named after the input file
+        self.config['legacy_cache_file'] = os.path.join(tempfile.gettempdir(),
+                                                        os.path.basename(self.config['input_path']
+                                                                         .replace('.csv',
+                                                                                  '_{}_scores.tsv'.format(metric_name))))
+
+    def get_cache_key(self):
+        identity = json.dumps([type(self).__name__, self.model_name, cache.score_config(self.config)],
+                              sort_keys=True, default=str)
+        return cache.content_hash(self.config['input_path'], identity)[:32]
 
     @abstractmethod
     def calc_scores(self):
         # input: input_csv
-        # output: save score file (as temp_file)
+        # output: save score file (as temp_file) with save_similarity_scores
         pass
 
-    def create_input_tsv(self):
-        # reformat input_csv for to a tsv file, as an input for sentence similarity neural models
-
-        out_fields = ['index', 'sentence1_id', 'sentence2_id', 'sentence1', 'sentence2']
-        f_in = open(self.config['input_path'], 'r')
-        f_out = open(self.config['input_tsv'], 'w')
-        reader = csv.DictReader(f_in, dialect='excel')
-        writer = csv.DictWriter(f_out, fieldnames=out_fields, dialect='excel-tab')
-        writer.writeheader()
-
-        for idx, in_row in enumerate(reader):
-            for i in range(self.config['samples_per_set']):
-                for j in range(i):
-                    writer.writerow({
-                        'index': idx,
-                        'sentence1_id': i,
-                        'sentence2_id': j,
-                        'sentence1': in_row['resp_{}'.format(i)],
-                        'sentence2': in_row['resp_{}'.format(j)],
-                    })
-
-        f_in.close()
-        f_out.close()
+    @property
+    def pairs_per_set(self):
+        # scored pairs per set - choose(samples_per_set, 2), or sampled_pairs in the sampled pairs mode
+        return self.num_scored_pairs(self.config['samples_per_set'])
+
+    @property
+    def pairs_file(self):
+        return global_disk_cache.pairs_path(self.config['cache_file'])
+
+    def save_scored_pairs(self):
+        # record the (i, j) pairs of each row of the cache file, in the sampled pairs mode
+        tmp_file = '{}.{}.tmp.npy'.format(self.pairs_file, os.getpid())
+        pairs = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.int32,
+                                          shape=(self.config['num_sets'], self.pairs_per_set, 2))
+        for idx, response_set in enumerate(self.iter_response_sets()):
+            pairs[idx] = np.stack(self.sample_pairs(response_set), axis=-1)
+        pairs.flush()
+        del pairs
+        os.replace(tmp_file, self.pairs_file)
+
+    def load_scored_pairs(self):
+        """
+        :return: [num_sets, pairs_per_set, 2] array of the (i, j) pair of each similarity score
+        """
+        self.get_similarity_scores()  # calc if needed
+        if self.sampled:
+            return np.load(self.pairs_file, mmap_mode='r')
+        pairs = np.stack(np.tril_indices(self.config['samples_per_set'], -1), axis=-1)
+        return np.broadcast_to(pairs, (self.config['num_sets'],) + pairs.shape)
+
+    def save_similarity_scores(self, scores):
+        """
+        Save the similarity scores as a binary cache file. The .npy header holds the [num_sets, pairs_per_set] shape,
+        so the file can be memory mapped and validated against num_sets and samples_per_set when loading.
+        :param scores: num_sets * pairs_per_set similarity scores, in the ordering of iter_pairs
+        """
+        scores = np.reshape(np.asarray(scores, dtype=np.float32), [self.config['num_sets'], self.pairs_per_set])
+        tmp_file = '{}.{}.tmp.npy'.format(self.config['cache_file'], os.getpid())
+        np.save(tmp_file, scores)
+        os.replace(tmp_file, self.config['cache_file'])  # never leave a partially written cache
+
+    def load_tsv_scores(self, tsv_path):
+        # text scores file, one score per line
+        with open(tsv_path, 'r') as cache_f:
+            scores = cache_f.read().split('\n')[:-1]
+        assert len(scores) == self.config['num_sets'] * self.pairs_per_set
+        return [float(e) for e in scores]
+
+    def iter_response_sets(self):
+        # lazily yield the response sets of the input csv
+        with open(self.config['input_path'], 'r') as f_in:
+            reader = csv.DictReader(f_in, dialect='excel')
+            for in_row in reader:
+                yield [in_row['resp_{}'.format(i)] for i in range(self.config['samples_per_set'])]
+
+    def iter_pairs(self):
+        """
+        Lazily yield all the pairs of the input csv, in the ordering of the cache file.
+        :return: generator of (set index, i, j, sentence i, sentence j) tuples, j < i
+        """
+        for idx, response_set in enumerate(self.iter_response_sets()):
+            for i, j in zip(*self.sample_pairs(response_set)):
+                yield idx, int(i), int(j), response_set[i], response_set[j]
+
+    def pair_deduplicator(self):
+        if not self.config['pair_dedup']:
+            return None
+        return PairDeduplicator(self.symmetric, self.identical_similarity)
+
+    def calc_pair_scores(self, score_pairs):
+        """
+        Stream all the pairs to a scorer in batches of batch_size pairs, and write the scores to the cache as they come.
+        Each batch is checkpointed, so an interrupted run resumes from the last completed batch.
+        With pair_dedup, only the unique pairs not scored in previous batches are sent to the scorer.
+        :param score_pairs: function (list of sentences 1, list of sentences 2) -> list of similarity scores
+        """
+        dedup = self.pair_deduplicator()
+        with ScoresCheckpoint(self.config, self.pairs_per_set) as checkpoint:
+            if checkpoint.done:  # calculated by another job meanwhile
+                return
+            pairs = itertools.islice(self.iter_pairs(), checkpoint.num_scored, None)
+            for batch in utils.batched(pairs, self.config.get('batch_size', DEFAULT_PAIRS_BATCH_SIZE)):
+                _, _, _, sentences_1, sentences_2 = zip(*batch)
+                if dedup is None:
+                    checkpoint.write(score_pairs(list(sentences_1), list(sentences_2)))
+                    continue
+                rows, new_pairs = dedup.index(sentences_1, sentences_2)
+                if len(new_pairs) > 0:
+                    dedup.add_scores(score_pairs([s for s, _ in new_pairs], [s for _, s in new_pairs]))
+                checkpoint.write(dedup.gather(rows))
+            checkpoint.finish()
+
+        if dedup is not None:
+            self.pair_stats = dedup.stats()
+            print('[{}] scored {unique_pairs} unique pairs out of {pairs} ({identical_pairs} identical, '
+                  '{dedup_ratio:.1%} deduplicated).'.format(self.config['input_path'], **self.pair_stats),
+                  file=sys.stderr)
+
+    def length_bucketed_map(self, batch_func, items, lengths):
+        """
+        Apply a neural model on items in length bucketed batches (see utils.length_bucketed_map), or in batches of the
+        original order if the config sets length_bucketing=False.
+        :param batch_func: function (list of items) -> list of results
+        :param lengths: list of item lengths (e.g. number of tokens)
+        :return: list of results, in the original order of items
+        """
+        max_batch_size = self.config.get('max_batch_size', DEFAULT_MAX_BATCH_SIZE)
+        if not self.config.get('length_bucketing', True):
+            return [result for batch in utils.batched(items, max_batch_size) for result in batch_func(batch)]
+        return utils.length_bucketed_map(batch_func, items, lengths,
+                                         max_batch_tokens=self.config.get('max_batch_tokens', DEFAULT_MAX_BATCH_TOKENS),
+                                         max_batch_size=max_batch_size)
 
     def get_similarity_scores(self):
 
         global global_score_cache  # Here we save the scores in memory for cheaper access
 
         # fetch or calc scores
-        if self.config['cache_file'] in global_score_cache.keys():
-            scores = global_score_cache[self.config['cache_file']]
-        else:
-            if not os.path.isfile(self.config['cache_file']) or self.config.get('ignore_cache', False):
-                self.calc_scores()
-            with open(self.config['cache_file'], 'r') as cache_f:
-                scores = cache_f.read().split('\n')[:-1]
-                assert len(scores) == self.config['num_sets'] * \
-                       sum([i for i in range(self.config['samples_per_set'])])  # choose(samples_per_set, 2)
-                scores = [float(e) for e in scores]
-                scores = np.reshape(scores, [self.config['num_sets'], -1])
-                global_score_cache[self.config['cache_file']] = scores  # cache
+        scores = global_score_cache.get(self.config['cache_file'])
+        if scores is None:
+            ignore_cache = self.config.get('ignore_cache', False)
+            if ignore_cache or not global_disk_cache.lookup(self.config['cache_file']) or \
+                    (self.sampled and not os.path.isfile(self.pairs_file)):
+                legacy_cache_file = self.config['legacy_cache_file']
+                if not ignore_cache and not self.sampled and os.path.isfile(legacy_cache_file) and \
+                        os.path.getmtime(legacy_cache_file) >= os.path.getmtime(self.config['input_path']):
+                    self.save_similarity_scores(self.load_tsv_scores(legacy_cache_file))  # convert
+                else:
+                    if self.sampled:
+                        self.save_scored_pairs()  # before the scores, so a cached scores file always has its pairs
+                    self.calc_scores()
+                global_disk_cache.evict(self.config['cache_dir'], self.config['max_cache_bytes'],
+                                        keep=[self.config['cache_file']])
+
+            # memory mapped - rows are paged in on access
+            scores = np.load(self.config['cache_file'], mmap_mode='r')
+            assert scores.shape == (self.config['num_sets'], self.pairs_per_set), \
+                '[{}] does not match num_sets and samples_per_set.'.format(self.config['cache_file'])
+            global_score_cache.put(self.config['cache_file'], scores)  # cache
         return scores
 
     def __call__(self, response_set_idx):
@@ -182,10 +665,32 @@ class Similarity2DiversityFromFileMetric(DiversityMetric):
         # validate input
         assert type(response_set_idx) == int
 
-        similarity_list = self.get_similarity_scores()[response_set_idx, :]
+        similarity_list = np.asarray(self.get_similarity_scores()[response_set_idx, :], dtype=np.float64)
         diversity_score = similarity2diversity_function(similarity_list)
         return diversity_score
 
+    def score_batch(self, response_set_indices):
+        """
+        Score many sets at once, directly over the cached [num_sets, pairs] scores matrix.
+        :param response_set_indices: list (or int array) of set indices
+        :return: [len(response_set_indices)] numpy array of diversity scores
+        """
+        response_set_indices = np.asarray(response_set_indices, dtype=np.int64)
+        assert response_set_indices.ndim == 1
+        similarities = np.asarray(self.get_similarity_scores()[response_set_indices], dtype=np.float64)
+        return -similarities.mean(axis=1)  # similarity2diversity_function of each row
+
+    def score_batch_with_se(self, response_set_indices):
+        if not self.sampled:
+            return super().score_batch_with_se(response_set_indices)
+        similarities = np.asarray(self.get_similarity_scores()[np.asarray(response_set_indices, dtype=np.int64)],
+                                  dtype=np.float64)
+        return similarities2diversity_with_se(list(similarities),
+                                              [self.config['samples_per_set']] * len(similarities))
+
+    def score_all(self):
+        return self.score_batch(np.arange(self.config['num_sets']))
+
 
 class AveragedNgramDiversityMetric(DiversityMetric):
     """
@@ -201,7 +706,16 @@ class AveragedNgramDiversityMetric(DiversityMetric):
         metric(response_set)
 
     inheritance guidelines:
-        implement __init__ only
+        implement __init__ only.
+        the n-gram metric class must implement tokenize(response_set) and calc_from_tokens(token_lists, n), so the
+        responses are tokenized once and shared by all n values.
+        it may also implement tokenize_batch(response_sets) and calc_batch_from_tokens(batch_tokens, n) -> numpy
+        array, so score_batch is vectorized across sets.
+        for the online accumulator (update / value), it may implement reset(), accumulator_tokens(responses),
+        update_from_tokens(tokens), merge(other) and value(), as DistinctNgrams does.
+        pairwise similarity n-gram metrics may implement pair_similarities_from_tokens(token_lists, rows, cols, n),
+        for the sampled pairs mode (see Similarity2DiversityMetric). The similarities of each sampled pair are averaged
+        over all n values, so the standard errors account for their correlation.
 
     inheritance example:
         see AveragedDistinctNgrams
@@ -216,20 +730,84 @@ class AveragedNgramDiversityMetric(DiversityMetric):
         err_msg = 'AveragedNgramMetric config must include n_max > n_min > 0 (int) representing n-gram size.'
         assert self.config['n_max'] > self.config['n_min'] > 0, err_msg
 
-        # add n field
-        self.config['n'] = self.config['n_min']
-
-        # instance ngram metric
+        # instance ngram metric - n is passed on each call, so the n field is only used for its config validation
         assert issubclass(ngram_metric_class, DiversityMetric)
-        self.ngram_metric = ngram_metric_class(self.config)
+        assert all([callable(getattr(ngram_metric_class, e, None)) for e in ['tokenize', 'calc_from_tokens']]), \
+            '{} must implement tokenize and calc_from_tokens.'.format(ngram_metric_class.__name__)
+        self.ngram_metric = ngram_metric_class(dict(self.config, n=self.config['n_min']))
+        assert not self.sampled or callable(getattr(self.ngram_metric, 'pair_similarities_from_tokens', None)), \
+            '{} does not support sampled_pairs.'.format(ngram_metric_class.__name__)
+        self.accumulators = None  # online accumulator, an n-gram metric instance per n, see update
 
     def __call__(self, response_set):
         super().__call__(response_set)
+        if self.sampled:
+            return self.score_batch_with_se([response_set])[0][0]
 
+        token_lists = self.ngram_metric.tokenize(response_set)  # tokenize once for all n values
         ngrams_results = []
         for n in range(self.config['n_min'], self.config['n_max'] + 1):
-            self.config['n'] = n
-            result = self.ngram_metric(response_set)
-            # print('{}, {}'.format(self.ngram_metric.config['n'], result))
-            ngrams_results.append(result)
+            ngrams_results.append(self.ngram_metric.calc_from_tokens(token_lists, n=n))
         return np.mean(ngrams_results)
+
+    def num_scored_pairs(self, set_size):
+        return self.ngram_metric.num_scored_pairs(set_size)  # per n value
+
+    def score_batch(self, response_sets):
+        if self.sampled:
+            return self.score_batch_with_se(response_sets)[0]
+        batch_methods = ['tokenize_batch', 'calc_batch_from_tokens']
+        if not all([callable(getattr(self.ngram_metric, e, None)) for e in batch_methods]):
+            return super().score_batch(response_sets)
+        self.response_sets_assert(response_sets)
+
+        batch_tokens = self.ngram_metric.tokenize_batch(response_sets)  # tokenize once for all n values
+        ngrams_results = []
+        for n in range(self.config['n_min'], self.config['n_max'] + 1):
+            ngrams_results.append(self.ngram_metric.calc_batch_from_tokens(batch_tokens, n=n))
+        return np.mean(ngrams_results, axis=0)
+
+    def score_batch_with_se(self, response_sets):
+        if not self.sampled:
+            return super().score_batch_with_se(response_sets)
+        self.response_sets_assert(response_sets)
+
+        similarity_lists = []
+        for response_set in response_sets:
+            # same pairs for all n values, tokenizing only their responses once
+            responses, rows, cols = utils.pairs_responses(*self.ngram_metric.sample_pairs(response_set))
+            token_lists = self.ngram_metric.tokenize([response_set[i] for i in responses])
+            ngrams_results = []
+            for n in range(self.config['n_min'], self.config['n_max'] + 1):
+                ngrams_results.append(self.ngram_metric.pair_similarities_from_tokens(token_lists, rows, cols, n=n))
+            similarity_lists.append(np.mean(ngrams_results, axis=0))
+        return similarities2diversity_with_se(similarity_lists, [len(e) for e in response_sets])
+
+    def reset(self):
+        assert callable(getattr(self.ngram_metric, 'update_from_tokens', None)), \
+            '{} does not support online accumulation.'.format(type(self.ngram_metric).__name__)
+        self.accumulators = [type(self.ngram_metric)(dict(self.config, n=n))
+                             for n in range(self.config['n_min'], self.config['n_max'] + 1)]
+
+    def update(self, responses):
+        """
+        Online accumulator - add responses to the running state of the n-gram metric of each n (see
+        DistinctNgrams.update), so value() is the mean over n of their values.
+        :param responses: a response (string) or a list of responses
+        """
+        if self.accumulators is None:
+            self.reset()
+        tokens = self.ngram_metric.accumulator_tokens([responses] if type(responses) == str else responses)
+        for accumulator in self.accumulators:  # tokenized once for all n values
+            accumulator.update_from_tokens(tokens)
+
+    def merge(self, other):
+        if self.accumulators is None:
+            self.reset()
+        for accumulator, other_accumulator in zip(self.accumulators, other.accumulators or []):
+            accumulator.merge(other_accumulator)
+
+    def value(self):
+        if self.accumulators is None:
+            self.reset()
+        return float(np.mean([accumulator.value() for accumulator in self.accumulators]))
@@ -2,13 +2,24 @@ from abc import ABC, abstractmethod
 import os
 import csv
 import json
-from scipy.stats import pearsonr, spearmanr, kendalltau, gaussian_kde
+import numpy as np
+from scipy.stats import pearsonr, spearmanr, kendalltau, gaussian_kde, rankdata
 
 # locals
 import utils
 
+RESAMPLES_CHUNK_ELEMENTS = 2 ** 22  # resamples are scored in chunks of up to [chunk, num_samples] this size
+PLOT_MODES = ['inline', 'defer', 'none']  # plot while running, save the plot data for a later render, or no plots
+PLOT_DATA_FILE = 'plot_data.npz'
+
 
 class MetricsTest(ABC):
+    default_config = {'bootstrap': 0,  # number of bootstrap resamples for confidence intervals (0 - off)
+                      'permutations': 0,  # number of label permutations for p-values (0 - off)
+                      'seed': 0,
+                      'ci': 0.95,  # confidence level of the intervals
+                      'plots': 'inline'}  # one of PLOT_MODES, used if publish_plots
+    one_sided_scores = []  # scores for which only higher values are as extreme (the others are two sided)
 
     def __init__(self):
         super().__init__()
@@ -17,7 +28,11 @@ class MetricsTest(ABC):
         self.check_config(config)
         data = self.collect_data(config)
         results = self.run(config, data)
-        self.visualize(config, data, results)
+        self.resample(config, data, results)
+        if config['publish_plots'] and config['plots'] != 'none':
+            self.save_plot_data(config, data, results)
+            if config['plots'] == 'inline':
+                self.visualize(config, data, results)
         self.export(config, data, results)
 
     @abstractmethod
@@ -25,22 +40,39 @@ class MetricsTest(ABC):
         expected_keys = ['sub_exp_name', 'exp_name', 'input_csv', 'out_dir',
                          'global_results_json', 'publish_plots', 'publish_results', 'class_name']
         for key in expected_keys: assert key in config.keys()
-        assert os.path.isfile(config['input_csv'])
+        assert os.path.isfile(config['input_csv']) or os.path.isfile(utils.npz_path(config['input_csv']))
         assert os.path.isdir(config['out_dir'])
         assert type(config['publish_plots']) == type(config['publish_results']) == bool
         assert self.__class__.__name__ == config['class_name']
+        for key, value in self.default_config.items():
+            config.setdefault(key, value)
+        assert type(config['bootstrap']) == type(config['permutations']) == int
+        assert config['bootstrap'] >= 0 and config['permutations'] >= 0
+        assert 0. < config['ci'] < 1.
+        assert config['plots'] in PLOT_MODES
+        config.setdefault('results_fragment_json', os.path.join(config['out_dir'], 'results_fragment.json'))
 
     @abstractmethod
     def collect_data(self, config):
-        with open(config['input_csv'], 'r+', encoding='utf-8') as in_csv_f:
-            reader = csv.DictReader(in_csv_f)
-            fields_to_read = [f for f in reader.fieldnames
-                              if f.startswith(utils.LABEL_PREFIX) or f.startswith(utils.METRIC_FIELD_PREFIX)]
-            data = {f: [] for f in fields_to_read}
-            for row in reader:
-                for field in fields_to_read:
-                    element = row[field] if field == utils.LABEL_NAME_FIELD else float(row[field])
-                    data[field].append(element)
+        # prefer the columnar npz output of run_metrics.py (see --output_format), unless the csv is newer
+        npz_path = utils.npz_path(config['input_csv'])
+        if os.path.isfile(npz_path) and (not os.path.isfile(config['input_csv']) or
+                                         os.path.getmtime(npz_path) >= os.path.getmtime(config['input_csv'])):
+            with np.load(npz_path) as npz_f:
+                # only the needed columns are read
+                fields_to_read = [f for f in npz_f.files
+                                  if f.startswith(utils.LABEL_PREFIX) or f.startswith(utils.METRIC_FIELD_PREFIX)]
+                data = {f: npz_f[f].tolist() for f in fields_to_read}
+        else:
+            with open(config['input_csv'], 'r+', encoding='utf-8') as in_csv_f:
+                reader = csv.DictReader(in_csv_f)
+                fields_to_read = [f for f in reader.fieldnames
+                                  if f.startswith(utils.LABEL_PREFIX) or f.startswith(utils.METRIC_FIELD_PREFIX)]
+                data = {f: [] for f in fields_to_read}
+                for row in reader:
+                    for field in fields_to_read:
+                        element = row[field] if field == utils.LABEL_NAME_FIELD else float(row[field])
+                        data[field].append(element)
         assert all([e == data[utils.LABEL_NAME_FIELD][0] for e in data[utils.LABEL_NAME_FIELD]])
         data[utils.LABEL_NAME_FIELD] = data[utils.LABEL_NAME_FIELD][0]
         return data
@@ -48,13 +80,80 @@ class MetricsTest(ABC):
     @abstractmethod
     def run(self, config, data):
         labels_vector = data[utils.LABEL_VAL_FIELD]
-        metric_fields = [f for f in data.keys() if f.startswith(utils.METRIC_FIELD_PREFIX) and not f.endswith('_std')]
+        metric_fields = [f for f in data.keys() if f.startswith(utils.METRIC_FIELD_PREFIX)
+                         and not f.endswith(('_std', utils.STANDARD_ERROR_SUFFIX))]
         results = {f: {} for f in metric_fields}
         for metric_name, metric_results in results.items():
             metric_results['spearman_cor'], _ = spearmanr(labels_vector, data[metric_name])
             metric_results['pearson_cor'], _ = pearsonr(labels_vector, data[metric_name])
         return results
 
+    def bootstrap_scores(self, labels_vector, samples, indices):
+        """
+        Vectorized scores of many bootstrap resamples at once.
+        :param labels_vector: [N] labels
+        :param samples: [N] metric values
+        :param indices: [B, N] drawn data points of each resample
+        :return: dict of score name -> [B] array
+        """
+        weights = utils.index_counts(indices, len(samples))
+        return {'spearman_cor': utils.weighted_pearson(utils.weighted_ranks(labels_vector, weights),
+                                                       utils.weighted_ranks(samples, weights), weights),
+                'pearson_cor': utils.weighted_pearson(labels_vector, samples, weights)}
+
+    def permutation_scores(self, labels_vector, samples, permutations):
+        """
+        Vectorized scores of many label permutations at once.
+        :param permutations: [B, N] permuted indices of the labels
+        :return: dict of score name -> [B] array
+        """
+        weights = np.ones([1, len(samples)])
+        return {'spearman_cor': utils.weighted_pearson(rankdata(labels_vector)[permutations], rankdata(samples),
+                                                       weights),
+                'pearson_cor': utils.weighted_pearson(labels_vector[permutations], samples, weights)}
+
+    def resample(self, config, data, results):
+        """
+        Add bootstrap confidence intervals ([score]_ci) and permutation test p-values ([score]_pvalue) to the results.
+        All the resamples are drawn at once as an index matrix (shared by all metrics, so their intervals are paired)
+        and scored in vectorized chunks.
+        """
+        if config['bootstrap'] == 0 and config['permutations'] == 0:
+            return
+        labels_vector = np.asarray(data[utils.LABEL_VAL_FIELD], dtype=np.float64)
+        num_samples = len(labels_vector)
+        rng = np.random.default_rng(config['seed'])
+        bootstrap_indices = rng.integers(0, num_samples, size=[config['bootstrap'], num_samples])
+        permutations = rng.permuted(np.tile(np.arange(num_samples), [config['permutations'], 1]), axis=1)
+        chunk_size = max(1, RESAMPLES_CHUNK_ELEMENTS // max(num_samples, 1))
+
+        def chunked(score_func, samples, indices):
+            chunks = [score_func(labels_vector, samples, indices[start:start + chunk_size])
+                      for start in range(0, len(indices), chunk_size)]
+            return {score: np.concatenate([chunk[score] for chunk in chunks]) for score in chunks[0].keys()}
+
+        alpha = (1. - config['ci']) / 2.
+        for metric_name, metric_results in results.items():
+            samples = np.asarray(data[metric_name], dtype=np.float64)
+            if config['bootstrap'] > 0:
+                for score, values in chunked(self.bootstrap_scores, samples, bootstrap_indices).items():
+                    values = values[~np.isnan(values)]  # e.g. resamples with constant labels
+                    metric_results[score + '_ci'] = np.quantile(values, [alpha, 1. - alpha]).tolist() \
+                        if len(values) > 0 else [np.nan, np.nan]
+            if config['permutations'] > 0:
+                for score, values in chunked(self.permutation_scores, samples, permutations).items():
+                    observed = metric_results[score]
+                    if score not in self.one_sided_scores:
+                        values, observed = np.abs(values), abs(observed)
+                    num_extreme = np.count_nonzero(values >= observed - 1e-12)
+                    metric_results[score + '_pvalue'] = (num_extreme + 1.) / (len(values) + 1.)
+
+    def save_plot_data(self, config, data, results):
+        # the metric values and statistics, so that the plots can be rendered again without recomputation
+        plot_data = {field: np.asarray(values) for field, values in data.items()}
+        plot_data['meta'] = np.array(json.dumps({'config': config, 'results': results}))
+        np.savez_compressed(os.path.join(config['out_dir'], PLOT_DATA_FILE), **plot_data)
+
     @abstractmethod
     def visualize(self, config, data, results):
         pass
@@ -62,29 +161,80 @@ class MetricsTest(ABC):
     @abstractmethod
     def export(self, config, data, results):
         if config['publish_results']:
-            # read json if exists
-            global_json = {}
-            if os.path.isfile(config['global_results_json']):
-                with open(config['global_results_json'], 'r+', encoding='utf-8') as json_f:
-                    global_json = json.load(json_f)
-
-            # update json
-            global_json[config['sub_exp_name']] = results
-            with open(config['global_results_json'], 'w') as json_f:
-                json.dump(global_json, json_f, indent=4)
-
-            # write results CSVs
-            test_score_types = results[list(results.keys())[0]].keys()
-            sub_exp_list = list(global_json.keys())
-            csv_fields = [''] + sub_exp_list
-            for score_type in test_score_types:
-                csv_name = '{}_{}.csv'.format(config['exp_name'], score_type)
-                csv_dir = os.path.dirname(config['global_results_json'])
-                csv_path = os.path.join(csv_dir, csv_name)
-                with open(csv_path, 'w') as csv_f:
-                    writer = csv.DictWriter(csv_f, fieldnames=csv_fields)
-                    writer.writeheader()
-                    for metric in results.keys():
-                        out_row = {'': metric.replace(utils.METRIC_FIELD_PREFIX, '')}
-                        out_row.update({sub: '{:0.2f}'.format(global_json[sub][metric][score_type]) for sub in sub_exp_list})
-                        writer.writerow(out_row)
+            # each sub experiment writes its own results fragment, merged to the global results by merge_results
+            # (so that sub experiments can run in parallel)
+            tmp_path = config['results_fragment_json'] + '.tmp'
+            with open(tmp_path, 'w') as json_f:
+                json.dump({config['sub_exp_name']: results}, json_f, indent=4)
+            os.replace(tmp_path, config['results_fragment_json'])
+
+
+def load_plot_data(plot_data_path):
+    """
+    Load the plot data saved by MetricsTest.save_plot_data.
+    :param plot_data_path: path of a PLOT_DATA_FILE
+    :return: config, data and results - the visualize arguments
+    """
+    with np.load(plot_data_path) as plot_data:
+        meta = json.loads(str(plot_data['meta']))
+        data = {field: plot_data[field].tolist() for field in plot_data.files if field != 'meta'}
+    config = meta['config']
+    config['out_dir'] = os.path.dirname(plot_data_path)
+    return config, data, meta['results']
+
+
+def format_score(metric_results, score_type):
+    # e.g. 0.52 [0.47, 0.58]
+    if score_type not in metric_results:
+        return ''
+    score_str = '{:0.2f}'.format(metric_results[score_type]) if not score_type.endswith('_pvalue') else \
+        '{:0.3g}'.format(metric_results[score_type])
+    if score_type + '_ci' in metric_results:
+        score_str += ' [{:0.2f}, {:0.2f}]'.format(*metric_results[score_type + '_ci'])
+    return score_str
+
+
+def merge_results(exp_name, global_results_json, fragment_paths):
+    """
+    Merge the results fragments of an experiment's sub experiments to the global results json (keeping the sub
+    experiments of previous runs) and write the per-score results CSVs.
+    :param exp_name: experiment name, the CSVs prefix
+    :param global_results_json: path
+    :param fragment_paths: list of the sub experiments results fragments, in order
+    """
+    # read json if exists
+    global_json = {}
+    if os.path.isfile(global_results_json):
+        with open(global_results_json, 'r+', encoding='utf-8') as json_f:
+            global_json = json.load(json_f)
+
+    # update json
+    csv_metrics = {}  # score type -> metrics (rows) of its CSV
+    for fragment_path in fragment_paths:
+        with open(fragment_path, 'r+', encoding='utf-8') as json_f:
+            fragment = json.load(json_f)
+        global_json.update(fragment)
+        for results in fragment.values():
+            # confidence intervals are written next to their scores
+            for score_type in [k for k in results[list(results.keys())[0]].keys() if not k.endswith('_ci')]:
+                csv_metrics[score_type] = list(results.keys())
+    tmp_path = global_results_json + '.tmp'
+    with open(tmp_path, 'w') as json_f:
+        json.dump(global_json, json_f, indent=4)
+    os.replace(tmp_path, global_results_json)
+
+    # write results CSVs
+    sub_exp_list = list(global_json.keys())
+    csv_fields = [''] + sub_exp_list
+    for score_type, metrics in csv_metrics.items():
+        csv_name = '{}_{}.csv'.format(exp_name, score_type)
+        csv_dir = os.path.dirname(global_results_json)
+        csv_path = os.path.join(csv_dir, csv_name)
+        with open(csv_path, 'w') as csv_f:
+            writer = csv.DictWriter(csv_f, fieldnames=csv_fields)
+            writer.writeheader()
+            for metric in metrics:
+                out_row = {'': metric.replace(utils.METRIC_FIELD_PREFIX, '')}
+                out_row.update({sub: format_score(global_json[sub].get(metric, {}), score_type)
+                                for sub in sub_exp_list})
+                writer.writerow(out_row)
@@ -0,0 +1,337 @@
+import argparse
+import os
+import sys
+import json
+import subprocess
+import time
+import tracemalloc
+import random
+
+#locals
+import utils
+
+
+def measure(func, *args, **kwargs):
+    # returns func output, wall time [sec] and peak python memory allocations [MB]
+    # (two separate runs, as tracemalloc slows down the run time)
+    start = time.perf_counter()
+    out = func(*args, **kwargs)
+    run_time = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, run_time, peak_mem / 2 ** 20
+
+
+def random_response_sets(num_sets, samples_per_set, resp_len, vocab_size, seed=0):
+    rand = random.Random(seed)
+    vocab = ['w{}'.format(i) for i in range(vocab_size)]
+    return [[' '.join(rand.choices(vocab, k=resp_len)) for _ in range(samples_per_set)] for _ in range(num_sets)]
+
+
+def bench_ngram_backend(params):
+    import numpy as np
+    import diversity_metrics
+    import similarity_metrics
+
+    response_sets = random_response_sets(params.num_sets, params.samples_per_set, params.resp_len, params.vocab_size)
+    print('ngram_backend: {} sets X {} samples X {} tokens'.format(params.num_sets, params.samples_per_set,
+                                                                   params.resp_len))
+    for metric_class in [diversity_metrics.AveragedDistinctNgrams, diversity_metrics.AveragedCosineSimilarity]:
+        scores = {}
+        for backend in utils.NGRAM_BACKENDS:
+            metric = metric_class(dict(metric_class.default_config, ngram_backend=backend))
+            scores[backend], run_time, peak_mem = measure(lambda: [metric(s) for s in response_sets])
+            print('\t{} [{}]: {:.3f} sec, peak mem {:.1f} MB'.format(metric_class.__name__, backend, run_time, peak_mem))
+        assert all([abs(a - b) < 1e-9 for a, b in zip(scores['tuple'], scores['hash'])]), 'backends disagree'
+
+    # the vectorized cosine similarities are those of the per pair code (scipy's cosine), to the bit
+    for backend in utils.NGRAM_BACKENDS:
+        similarity = similarity_metrics.CosineSimilarity({'n': 2, 'ngram_backend': backend})
+        for response_set in random_response_sets(20, params.samples_per_set, params.resp_len, 20):
+            rows, cols = np.tril_indices(len(response_set), -1)
+            assert similarity.pairwise_similarities(response_set) == \
+                [similarity(response_set[i], response_set[j]) for i, j in zip(rows, cols)], \
+                'vectorized cosine similarities differ from the per pair code'
+
+    # a vocabulary whose n-gram codes wrap 64 bits (8192^5 = 2^65): with base vocab_size, ids 5 and 4101 collide
+    vocab = ['w{}'.format(i) for i in range(8192)]
+    wrapping_set = [' '.join(vocab), ' '.join([vocab[4101]] + vocab[6:10])]
+    for metric_class in [diversity_metrics.DistinctNgrams, diversity_metrics.CosineSimilarity2Diversity]:
+        scores = {}
+        for backend in utils.NGRAM_BACKENDS:
+            metric = metric_class(dict(metric_class.default_config, n=5, ngram_backend=backend))
+            scores[backend] = [metric(wrapping_set)] + list(metric.score_batch([wrapping_set, wrapping_set[::-1]]))
+        assert np.allclose(scores['tuple'], scores['hash']), 'backends disagree on a wrapping vocabulary'
+    print('\twrapping vocabulary (8192 tokens, n=5): backends agree')
+
+
+def bench_length_bucketing(params):
+    import numpy as np
+    import metric
+    import backends
+
+    # sentences of varied lengths, as in generation samples
+    rand = random.Random(0)
+    sentences = [' '.join(['w{}'.format(rand.randrange(params.vocab_size)) for _ in range(rand.randint(1, params.resp_len))])
+                 for _ in range(params.num_sets * params.samples_per_set)]
+    lengths = [utils.num_tokens(s) for s in sentences]
+    model = backends.HashingEncoder()
+    model.encode(sentences)  # warm up token vectors
+    encode_batch = lambda batch: model.encode(batch, batch_size=len(batch))
+
+    print('length_bucketing: {} sentences of 1-{} tokens, local stand-in encoder'.format(len(sentences), params.resp_len))
+    embeds = {}
+    for name, batches_func in [('file order', lambda: [r for b in utils.batched(sentences, metric.DEFAULT_MAX_BATCH_SIZE)
+                                                       for r in encode_batch(b)]),
+                               ('bucketed', lambda: utils.length_bucketed_map(encode_batch, sentences, lengths,
+                                                                              metric.DEFAULT_MAX_BATCH_TOKENS,
+                                                                              metric.DEFAULT_MAX_BATCH_SIZE))]:
+        start = time.perf_counter()
+        embeds[name] = np.array(batches_func())
+        run_time = time.perf_counter() - start
+        print('\t[{}]: {:.1f} sentences/sec'.format(name, len(sentences) / run_time))
+    assert np.allclose(embeds['file order'], embeds['bucketed'], atol=1e-5), 'bucketed results are out of order'
+
+
+def bench_score_batch(params):
+    import numpy as np
+    import diversity_metrics
+
+    response_sets = random_response_sets(params.num_sets, params.samples_per_set, params.resp_len, params.vocab_size)
+    print('score_batch: {} sets X {} samples X {} tokens'.format(params.num_sets, params.samples_per_set,
+                                                                 params.resp_len))
+    for metric_class in [diversity_metrics.AveragedDistinctNgrams, diversity_metrics.AveragedCosineSimilarity]:
+        for backend in utils.NGRAM_BACKENDS:
+            metric = metric_class(dict(metric_class.default_config, ngram_backend=backend))
+            per_set, per_set_time, _ = measure(lambda: np.array([metric(s) for s in response_sets]))
+            batch, batch_time, peak_mem = measure(lambda: metric.score_batch(response_sets))
+            print('\t{} [{}]: per set {:.3f} sec, score_batch {:.3f} sec (peak mem {:.1f} MB)'.format(
+                metric_class.__name__, backend, per_set_time, batch_time, peak_mem))
+            assert np.allclose(per_set, batch, atol=1e-9), 'score_batch disagrees with per set calls'
+
+
+def bench_pair_dedup(params):
+    import csv
+    import shutil
+    import tempfile
+    import numpy as np
+    import diversity_metrics
+
+    # collapsed response sets, as in low temperature decoding - each set draws from a few distinct responses
+    rand = random.Random(0)
+    distinct = random_response_sets(params.num_sets, 3, params.resp_len, params.vocab_size)
+    response_sets = [[rand.choice(resps) for _ in range(params.samples_per_set)] for resps in distinct]
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_path = os.path.join(work_dir, 'collapsed.csv')
+        with open(input_path, 'w') as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(['resp_{}'.format(i) for i in range(params.samples_per_set)])
+            writer.writerows(response_sets)
+
+        print('pair_dedup: {} collapsed sets X {} samples, BertSts with the local sts backend'.format(
+            params.num_sets, params.samples_per_set))
+        scores = {}
+        for pair_dedup in [False, True]:
+            metric = diversity_metrics.BertSts(dict(diversity_metrics.BertSts.default_config, input_path=input_path,
+                                                    num_sets=params.num_sets, samples_per_set=params.samples_per_set,
+                                                    sts_backend='local', cache_dir=work_dir, ignore_cache=True,
+                                                    pair_dedup=pair_dedup))
+            start = time.perf_counter()
+            metric.calc_scores()
+            run_time = time.perf_counter() - start
+            scores[pair_dedup] = np.load(metric.config['cache_file'])
+            print('	[pair_dedup={}]: {:.3f} sec'.format(pair_dedup, run_time))
+        assert np.array_equal(scores[False], scores[True]), 'deduplicated scores disagree'
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def bench_sampled_pairs(params):
+    import numpy as np
+    import diversity_metrics
+
+    # large sets, scored on samples_per_set pairs instead of all their pairs
+    samples_per_set = 10 * params.samples_per_set
+    response_sets = random_response_sets(params.num_sets, samples_per_set, params.resp_len // 10,
+                                         params.vocab_size // 100)
+    print('sampled_pairs: {} sets X {} samples X {} tokens, {} sampled pairs per set'.format(
+        params.num_sets, samples_per_set, params.resp_len // 10, params.samples_per_set))
+    metric_class = diversity_metrics.AveragedCosineSimilarity
+    exact, exact_time, _ = measure(lambda: metric_class(dict(metric_class.default_config)).score_batch(response_sets))
+    print('\t[all pairs]: {:.3f} sec'.format(exact_time))
+    for pair_sampling in utils.PAIR_SAMPLINGS:
+        metric = metric_class(dict(metric_class.default_config, sampled_pairs=params.samples_per_set,
+                                   pair_sampling=pair_sampling))
+        (scores, standard_errors), run_time, _ = measure(lambda: metric.score_batch_with_se(response_sets))
+        print('\t[{}]: {:.3f} sec, mean |error| / standard error {:.2f}'.format(
+            pair_sampling, run_time, np.mean(np.abs(scores - exact) / standard_errors)))
+
+
+def bench_online_distinct(params):
+    import diversity_metrics
+
+    # one stream of all the responses, e.g. generations read from logs
+    responses = [resp for response_set in random_response_sets(params.num_sets, params.samples_per_set,
+                                                               params.resp_len, params.vocab_size)
+                 for resp in response_set]
+    print('online_distinct: a stream of {} responses X {} tokens'.format(len(responses), params.resp_len))
+    metric_class = diversity_metrics.AveragedDistinctNgrams
+    exact = metric_class(dict(metric_class.default_config))(responses)
+    for backend, approx in [('tuple', False), ('hash', False), ('hash', True)]:
+        accumulator = metric_class(dict(metric_class.default_config, ngram_backend=backend, approx=approx))
+
+        def stream():
+            accumulator.reset()
+            for resp in responses:
+                accumulator.update(resp)
+            return accumulator.value()
+
+        value, run_time, peak_mem = measure(stream)
+        print('\t[{}{}]: {:.1f} responses/sec, peak mem {:.1f} MB, relative error {:.2e}'.format(
+            backend, ', approx' if approx else '', len(responses) / run_time, peak_mem, abs(value / exact - 1.)))
+        if not approx:
+            assert abs(value - exact) < 1e-9, 'online accumulator disagrees with the batch metric'
+
+
+def exhaustive_optimal_classification_accuracy(group_1, group_2):
+    # the original O(N^2) utils.optimal_classification_accuracy, kept as a reference
+    import numpy as np
+
+    accuracy_list = []
+    th_list = []
+    all_samples = group_1 + group_2
+    for separator in all_samples:
+        group_1_left = sum([v <= separator + 1e-5 for v in group_1])
+        group_2_right = sum([v > separator + 1e-5 for v in group_2])
+        acc = (group_1_left + group_2_right) / len(all_samples)
+        th_list.append(separator)
+        accuracy_list.append(acc if acc > 0.5 else 1 - acc)
+
+    best_separator_idx = np.argmax(accuracy_list)
+    return accuracy_list[best_separator_idx], th_list[best_separator_idx]
+
+
+def bench_oca(params):
+    # regression - groups with ties, values closer than the 1e-5 margin, and nans
+    rand = random.Random(0)
+    for _ in range(500):
+        values = [round(rand.gauss(0, 1), rand.choice([1, 2, 5])) for _ in range(rand.randint(1, 60))]
+        values += [v + rand.choice([1e-6, 1e-5, 2e-5]) for v in rand.sample(values, len(values) // 4)]
+        values += [float('nan')] * rand.choice([0, 0, 1])
+        rand.shuffle(values)
+        split = rand.randint(0, len(values))
+        group_1, group_2 = values[:split], values[split:]
+        expected = exhaustive_optimal_classification_accuracy(group_1, group_2)
+        assert utils.optimal_classification_accuracy(group_1, group_2) == expected, (group_1, group_2)
+
+    print('oca: optimal_classification_accuracy vs the exhaustive O(N^2) search')
+    for num_samples in [1000, 4000]:
+        group_1 = [rand.gauss(0, 1) for _ in range(num_samples // 2)]
+        group_2 = [rand.gauss(0.5, 1) for _ in range(num_samples // 2)]
+        expected, exhaustive_time, _ = measure(exhaustive_optimal_classification_accuracy, group_1, group_2)
+        out, run_time, _ = measure(utils.optimal_classification_accuracy, group_1, group_2)
+        assert out == expected
+        print('\t{} samples: {:.4f} sec (exhaustive {:.3f} sec)'.format(num_samples, run_time, exhaustive_time))
+    group_1 = [rand.gauss(0, 1) for _ in range(50000)]
+    group_2 = [rand.gauss(0.5, 1) for _ in range(50000)]
+    _, run_time, _ = measure(utils.optimal_classification_accuracy, group_1, group_2)
+    print('\t100000 samples: {:.4f} sec'.format(run_time))
+
+
+def bench_collect_data(params):
+    import csv
+    import shutil
+    import tempfile
+    import numpy as np
+    import dec_test
+
+    # a with_metrics file of num_sets rows, 10 metrics, in both output formats of run_metrics.py
+    rand = random.Random(0)
+    response_sets = random_response_sets(params.num_sets, params.samples_per_set, params.resp_len, params.vocab_size)
+    columns = {'sample_id': [str(i) for i in range(params.num_sets)]}
+    columns.update({'resp_{}'.format(i): [s[i] for s in response_sets] for i in range(params.samples_per_set)})
+    columns.update({utils.LABEL_VAL_FIELD: [rand.random() for _ in response_sets],
+                    utils.LABEL_NAME_FIELD: ['temp'] * params.num_sets})
+    columns.update({'{}m{}'.format(utils.METRIC_FIELD_PREFIX, i): [rand.random() for _ in response_sets]
+                    for i in range(10)})
+    tmp_dir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmp_dir, 'with_metrics.csv')
+    with open(csv_path, 'w', encoding='utf-8') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+    test = dec_test.DecTest()
+    csv_data, csv_time, _ = measure(test.collect_data, {'input_csv': csv_path})
+    np.savez(utils.npz_path(csv_path), **{k: np.asarray(v) for k, v in columns.items()})
+    npz_data, npz_time, _ = measure(test.collect_data, {'input_csv': csv_path})
+    shutil.rmtree(tmp_dir)
+
+    print('collect_data: {} rows X {} responses of {} tokens, 10 metrics'.format(params.num_sets, params.samples_per_set,
+                                                                                params.resp_len))
+    print('\tcsv: {:.4f} sec, npz: {:.4f} sec'.format(csv_time, npz_time))
+    assert npz_data == csv_data, 'the npz and csv data differ'
+
+
+HEAVY_MODULES = ['torch', 'transformers', 'bert_score', 'sentence_transformers', 'scipy', 'matplotlib', 'requests']
+IMPORT_TIME_SCRIPT = """
+import sys, time, json, resource
+start = time.perf_counter()
+import run_metrics
+metric = run_metrics.diversity_metrics.{metric_name}
+metric(dict(metric.default_config))
+sec = time.perf_counter() - start
+try:
+    # the peak rss of this process image - ru_maxrss keeps the benchmark process' peak across fork + exec
+    with open('/proc/self/status', 'r') as status_f:
+        max_rss_mb = [int(line.split()[1]) for line in status_f if line.startswith('VmHWM:')][0] / 2 ** 10
+except (OSError, IndexError):
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+print(json.dumps({{'sec': sec, 'max_rss_mb': max_rss_mb,
+                  'heavy_modules': [m for m in {heavy_modules} if m in sys.modules]}}))
+"""
+
+
+def bench_import_time(params):
+    # a fresh interpreter per metric, as run_metrics.py starts - importing the run file and instantiating the metric
+    print('import_time: import run_metrics + instantiate the metric, in a fresh process')
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    for metric_name in ['AveragedDistinctNgrams', 'AveragedCosineSimilarity']:
+        script = IMPORT_TIME_SCRIPT.format(metric_name=metric_name, heavy_modules=HEAVY_MODULES)
+        out = json.loads(subprocess.run([sys.executable, '-c', script], cwd=repo_dir, check=True,
+                                        stdout=subprocess.PIPE, encoding='utf-8').stdout)
+        print('\t{}: {:.3f} sec, max rss {:.1f} MB, heavy modules loaded: {}'.format(
+            metric_name, out['sec'], out['max_rss_mb'], out['heavy_modules']))
+        if metric_name == 'AveragedDistinctNgrams':
+            assert out['heavy_modules'] == [], 'AveragedDistinctNgrams path imports heavy modules'
+
+
+benchmarks = {'ngram_backend': bench_ngram_backend,
+              'length_bucketing': bench_length_bucketing,
+              'score_batch': bench_score_batch,
+              'pair_dedup': bench_pair_dedup,
+              'sampled_pairs': bench_sampled_pairs,
+              'online_distinct': bench_online_distinct,
+              'oca': bench_oca,
+              'collect_data': bench_collect_data,
+              'import_time': bench_import_time}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the run time and memory of metrics and utilities.')
+
+    # main parameters
+    parser.add_argument("--benchmarks", type=str, default='',
+                        help='Benchmarks to run. Support multiple, comma separated. By default, will run all of: '
+                             + ', '.join(benchmarks.keys()))
+    parser.add_argument("--num_sets", type=int, default=100, help='Number of synthetic response sets.')
+    parser.add_argument("--samples_per_set", type=int, default=10, help='Number of responses in each set.')
+    parser.add_argument("--resp_len", type=int, default=200, help='Number of tokens in each response.')
+    parser.add_argument("--vocab_size", type=int, default=5000, help='Synthetic vocabulary size.')
+
+    params = parser.parse_args()
+    for bench_name in (params.benchmarks.split(',') if params.benchmarks != '' else benchmarks.keys()):
+        benchmarks[bench_name](params)
@@ -1,15 +1,37 @@
 import argparse
 import json
 import os
+import multiprocessing
 
 # locals
 import utils
+import metrics_test
 import con_test, dec_test
 test_classes = [con_test.ConTest, dec_test.DecTest]
 
 
-def run_experiment(params):
-    # parse experiments
+def init_worker():
+    # figures are only saved to files
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def run_sub_experiment(sub_exp_config):
+    if not os.path.isdir(sub_exp_config['out_dir']):
+        os.makedirs(sub_exp_config['out_dir'])
+    test = {cls.__name__: cls for cls in test_classes}[sub_exp_config['class_name']]()
+    test(sub_exp_config)
+    return sub_exp_config
+
+
+def render_sub_experiment(plot_data_path):
+    config, data, results = metrics_test.load_plot_data(plot_data_path)
+    test = {cls.__name__: cls for cls in test_classes}[config['class_name']]()
+    test.visualize(config, data, results)
+    return config
+
+
+def parse_experiments(params):
     experiments_dict = {os.path.basename(path).replace('.json', ''): {'experiment_path': path,
                                                                       'config_dict': {}} for path in
                         utils.parse_path_list(params.input_json,
@@ -28,22 +50,65 @@ def run_experiment(params):
                     'out_dir': os.path.join(exp_params['out_dir'], sub_exp_name),
                     'global_results_json': os.path.join(exp_params['out_dir'], 'results.json'),
                     'class_name': exp_json['global_config']['class_name'],
-                    'publish_plots': True,
+                    'publish_plots': params.plots != 'none',
+                    'plots': params.plots,
                     'publish_results': True,
+                    'bootstrap': params.bootstrap,
+                    'permutations': params.permutations,
+                    'seed': params.seed,
+                    'ci': params.ci,
+                    'results_fragment_json': os.path.join(exp_params['out_dir'], sub_exp_name,
+                                                          'results_fragment.json'),
                 }
                 exp_params['config_dict'].update({sub_exp_name: sub_exp_config})
+    return experiments_dict
+
+
+def map_sub_experiments(func, args, params, plots):
+    # yields the done sub experiments configs, in order
+    if params.workers > 1:
+        with multiprocessing.Pool(params.workers, initializer=init_worker if plots else None) as pool:
+            yield from pool.imap(func, args)
+    else:
+        if plots:
+            init_worker()
+        yield from map(func, args)
+
+
+def print_progress(sub_exp_configs):
+    exp_name = None
+    for sub_exp_config in sub_exp_configs:
+        if sub_exp_config['exp_name'] != exp_name:
+            exp_name = sub_exp_config['exp_name']
+            print('Running [{}]'.format(exp_name))
+        print('\t- [{}]'.format(sub_exp_config['sub_exp_name']))
+
+
+def render(params):
+    # render the plots of previous runs from their saved plot data (see --plots)
+    plot_data_paths = []
+    for exp_params in parse_experiments(params).values():
+        for sub_exp_config in exp_params['config_dict'].values():
+            plot_data_path = os.path.join(sub_exp_config['out_dir'], metrics_test.PLOT_DATA_FILE)
+            assert os.path.isfile(plot_data_path), '[{}] not exists - run the experiment first.'.format(plot_data_path)
+            plot_data_paths.append(plot_data_path)
+    print_progress(map_sub_experiments(render_sub_experiment, plot_data_paths, params, plots=True))
+
+
+def run_experiment(params):
+    experiments_dict = parse_experiments(params)
 
-    # instance all tests
-    test_dict = {cls.__name__: cls() for cls in test_classes}
+    # run experiments - sub experiments are independent, so they can run in parallel
+    sub_exp_configs = [sub_exp_config for exp_params in experiments_dict.values()
+                       for sub_exp_config in exp_params['config_dict'].values()]
+    print_progress(map_sub_experiments(run_sub_experiment, sub_exp_configs, params, plots=params.plots == 'inline'))
 
-    # run experiments
+    # merge the sub experiments results
     for exp_name, exp_params in experiments_dict.items():
-        print('Running [{}]'.format(exp_name))
-        for sub_exp_name, sub_exp_config in exp_params['config_dict'].items():
-            print('\t- [{}]'.format(sub_exp_name))
-            if not os.path.isdir(sub_exp_config['out_dir']):
-                os.makedirs(sub_exp_config['out_dir'])
-            test_dict[sub_exp_config['class_name']](sub_exp_config)
+        sub_exp_configs = [c for c in exp_params['config_dict'].values() if c['publish_results']]
+        if len(sub_exp_configs) > 0:
+            metrics_test.merge_results(exp_name, sub_exp_configs[0]['global_results_json'],
+                                       [c['results_fragment_json'] for c in sub_exp_configs])
 
 
 if __name__ == '__main__':
@@ -54,7 +119,23 @@ if __name__ == '__main__':
     parser.add_argument("--input_json", type=str, default='',
                         help='Input results csv file. Support multiple, comma separated, or dirs. '
                              'By default, will handle all files in ./data/experiments/')
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help='Number of bootstrap resamples for confidence intervals of the scores. 0 for none.')
+    parser.add_argument("--permutations", type=int, default=0,
+                        help='Number of label permutations for p-values of the scores. 0 for none.')
+    parser.add_argument("--seed", type=int, default=0, help='Random seed of the resamples.')
+    parser.add_argument("--ci", type=float, default=0.95, help='Confidence level of the intervals.')
+    parser.add_argument("--workers", type=int, default=1,
+                        help='Number of processes running (or rendering) sub experiments in parallel.')
+    parser.add_argument("--plots", type=str, default='inline', choices=metrics_test.PLOT_MODES,
+                        help='inline - plot while running. defer - only save the plot data, for a later --render. '
+                             'none - no plots (matplotlib is not imported).')
+    parser.add_argument("--render", action='store_true',
+                        help='Only render the plots of the experiments from the plot data saved by a previous run.')
 
     params = parser.parse_args()
-    utils.download_and_place_data()
-    run_experiment(params)
+    if params.render:
+        render(params)
+    else:
+        utils.download_and_place_data()
+        run_experiment(params)
@@ -1,15 +1,317 @@
 import argparse
 import os
 import csv
+import json
 import sys
+import time
+import shutil
+import pstats
+import cProfile
+import tempfile
 import inspect
+import multiprocessing
+from collections import deque
 from copy import deepcopy
+import numpy as np
 
 #locals
 import utils
+import metric
 import diversity_metrics
 
 
+STD_STREAM = '-'  # input_csv / output_csv value for reading from stdin / writing to stdout
+
+# worker state - instances of the response set metrics, built once per worker process
+worker_metrics = {}
+
+
+def init_worker(metrics_configs):
+    global worker_metrics
+    worker_metrics = {field_name: metric(config) for field_name, (metric, config) in metrics_configs.items()}
+
+
+def score_fields(metric, field_name, inputs):
+    # the scores of a metric - with the standard errors of its estimates, in the sampled pairs mode
+    if metric.sampled:
+        scores, standard_errors = metric.score_batch_with_se(inputs)
+        return {field_name: scores, field_name + utils.STANDARD_ERROR_SUFFIX: standard_errors}
+    return {field_name: metric.score_batch(inputs)}
+
+
+def calc_chunk(field_names, resp_sets):
+    # returns the scores, and the (seconds, scored pairs) of each metric, for the run report
+    scores = {}
+    stats = {}
+    for field_name in field_names:
+        start = time.perf_counter()
+        scores.update(score_fields(worker_metrics[field_name], field_name, resp_sets))
+        stats[field_name] = (time.perf_counter() - start,
+                             sum([worker_metrics[field_name].num_scored_pairs(len(e)) for e in resp_sets]))
+    return scores, stats
+
+
+def peak_memory_mb():
+    # peak resident memory of this process and of its (finished) child processes, e.g. the workers
+    try:
+        import resource  # unix only
+    except ImportError:
+        return None
+    scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10  # ru_maxrss is in bytes on macOS, KB on linux
+    return {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale}
+
+
+class RunReport:
+    """
+    Collects where the time of a run goes - the wall time of each file, and the time, rows and scored pairs of each
+    metric in each file (summed over the workers), as a machine readable report (see --report).
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = {}
+
+    def file_report(self, path):
+        return self.files.setdefault(path, {'sec': 0., 'rows': 0, 'metrics': {}, 'start': time.perf_counter()})
+
+    def add_rows(self, path, num_rows):
+        self.file_report(path)['rows'] += num_rows
+
+    def add_metric(self, path, field_name, sec, num_rows, num_pairs):
+        metric_report = self.file_report(path)['metrics'].setdefault(field_name, {'sec': 0., 'rows': 0, 'pairs': 0})
+        metric_report['sec'] += sec
+        metric_report['rows'] += num_rows
+        metric_report['pairs'] += num_pairs
+
+    def close_file(self, path, metrics_stats=None):
+        file_report = self.file_report(path)
+        file_report['sec'] = time.perf_counter() - file_report.pop('start')
+        for field_name, stats in (metrics_stats or {}).items():
+            file_report['metrics'][field_name].update(stats)
+
+    @staticmethod
+    def add_rates(report):
+        report['rows_per_sec'] = report['rows'] / report['sec'] if report['sec'] > 0 else None
+        if report.get('pairs', 0) > 0:
+            report['pairs_per_sec'] = report['pairs'] / report['sec'] if report['sec'] > 0 else None
+        return report
+
+    def as_dict(self, workers):
+        metrics_report = {}
+        for file_report in self.files.values():
+            self.add_rates(file_report)
+            for field_name, metric_report in file_report['metrics'].items():
+                self.add_rates(metric_report)
+                total = metrics_report.setdefault(field_name, {'sec': 0., 'rows': 0, 'pairs': 0})
+                for k in total.keys():
+                    total[k] += metric_report[k]
+        return {'sec': time.perf_counter() - self.start,
+                'rows': sum([file_report['rows'] for file_report in self.files.values()]),
+                'workers': workers,
+                'peak_memory_mb': peak_memory_mb(),
+                'metrics': {field_name: self.add_rates(e) for field_name, e in metrics_report.items()},
+                'files': self.files,
+                'caches': {'score_cache': metric.global_score_cache.stats(),
+                           'disk_cache': metric.global_disk_cache.stats()}}
+
+    def print_summary(self, report, file=None):
+        print('#' * 30, file=file)
+        print('Done in {:.1f} sec ({} rows). Time per metric (summed over workers):'.format(report['sec'],
+                                                                                          report['rows']), file=file)
+        for field_name, metric_report in sorted(report['metrics'].items(), key=lambda e: -e[1]['sec']):
+            print('\t{}: {:.2f} sec, {:.1f} rows/sec{}'.format(
+                field_name, metric_report['sec'], metric_report['rows_per_sec'] or 0.,
+                ', {:.1f} pairs/sec'.format(metric_report['pairs_per_sec'] or 0.)
+                if 'pairs_per_sec' in metric_report else ''), file=file)
+        print('caches: {}'.format(report['caches']), file=file)
+        if report['peak_memory_mb'] is not None:
+            print('peak memory [MB]: {main:.1f} (children {children:.1f})'.format(**report['peak_memory_mb']),
+                  file=file)
+
+
+def count_rows(path):
+    with open(path, 'r+', encoding='utf-8') as input_csv_f:
+        return sum([1 for _ in csv.DictReader(input_csv_f)])
+
+
+class NpzReader:
+    # reads the rows of a columnar npz (see --output_format) as dicts, as csv.DictReader. With the csv output next to
+    # it (csv_path), the non-metric fields are read from the csv, so labels keep their original text (e.g. 0, not 0.0)
+
+    def __init__(self, path, csv_path=None):
+        with np.load(path) as npz_f:
+            self.columns = {field_name: npz_f[field_name].tolist() for field_name in npz_f.files}
+        self.fieldnames = list(self.columns.keys())
+        if csv_path is not None:
+            with open(csv_path, 'r+', encoding='utf-8') as csv_f:
+                text_rows = list(csv.DictReader(csv_f))
+            assert all([len(values) == len(text_rows) for values in self.columns.values()]), \
+                '[{}] does not match [{}].'.format(csv_path, path)
+            for field_name in self.fieldnames:
+                if not field_name.startswith(utils.METRIC_FIELD_PREFIX):
+                    self.columns[field_name] = [row[field_name] for row in text_rows]
+
+    def __iter__(self):
+        for values in zip(*self.columns.values()):
+            yield dict(zip(self.fieldnames, values))
+
+
+def read_fieldnames(path):
+    if path.endswith('.npz'):
+        with np.load(path) as npz_f:
+            return npz_f.files
+    with open(path, 'r+', encoding='utf-8') as input_csv_f:
+        return csv.DictReader(input_csv_f).fieldnames
+
+
+def iter_chunks(csv_dict, chunk_size):
+    # yields the rows of all files to run, in order, in chunks of up to chunk_size rows
+    for path, param_dict in csv_dict.items():
+        if param_dict['run']:
+            in_path = param_dict['in_path']  # the input file, or its existing output in incremental mode
+            input_csv_f = None
+            if in_path == STD_STREAM:
+                input_csv_f = sys.stdin
+            elif not in_path.endswith('.npz'):
+                input_csv_f = open(in_path, 'r+', encoding='utf-8')
+            reader = param_dict.get('reader', None) or \
+                (NpzReader(in_path, param_dict.get('in_csv_path', None)) if input_csv_f is None
+                 else csv.DictReader(input_csv_f))
+            rows = []
+            num_rows = 0
+            for in_row in reader:
+                rows.append(in_row)
+                num_rows += 1
+                if len(rows) == chunk_size:
+                    yield {'path': path, 'fieldnames': reader.fieldnames, 'start_idx': num_rows - len(rows), 'rows': rows}
+                    rows = []
+            if len(rows) > 0:
+                yield {'path': path, 'fieldnames': reader.fieldnames, 'start_idx': num_rows - len(rows), 'rows': rows}
+            if input_csv_f not in [None, sys.stdin]:
+                input_csv_f.close()
+            assert num_rows > 0, '[{}] no samples in file'.format(path)
+
+
+def to_column(field_name, values):
+    # metric fields are float columns, label fields are float columns if possible (and strings otherwise)
+    if field_name.startswith(utils.METRIC_FIELD_PREFIX):
+        return np.asarray(values, dtype=np.float64)
+    if field_name.startswith(utils.LABEL_PREFIX):
+        try:
+            return np.asarray(values, dtype=np.float64)
+        except ValueError:
+            pass
+    return np.asarray(values, dtype=str)
+
+
+class ChunkWriter:
+    # writes calculated chunks, in order, to the out_path of their input file (and / or a columnar npz next to it)
+
+    def __init__(self, csv_dict, output_format='csv', report=None):
+        self.csv_dict = csv_dict
+        self.output_format = output_format
+        self.report = report or RunReport()
+        self.path = None
+        self.output_csv_f = None
+        self.writer = None
+        self.columns = None  # field name -> list of values, for the npz output
+
+    def write(self, chunk, scores):
+        param_dict = self.csv_dict[chunk['path']]
+        if chunk['path'] != self.path:
+            self.close()
+            self.path = chunk['path']
+
+            # handle files
+            out_dir = os.path.dirname(param_dict['out_path'])
+            if out_dir != '' and not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+
+            # stale metric fields (incremental mode) are recalculated in place, and the stale standard errors of metrics
+            # recalculated without sampled pairs are dropped
+            metrics_fields = [field_name for metric_params in param_dict['metrics_to_calc'].values()
+                              for field_name in metric_params['out_fields']]
+            dropped_fields = [metric_params['field_name'] + utils.STANDARD_ERROR_SUFFIX
+                              for metric_params in param_dict['metrics_to_calc'].values()]
+            out_fields = [field_name for field_name in chunk['fieldnames']
+                          if field_name in metrics_fields or field_name not in dropped_fields] + \
+                         [field_name for field_name in metrics_fields if field_name not in chunk['fieldnames']]
+            if self.output_format in ['csv', 'both']:
+                if param_dict['out_path'] == STD_STREAM:
+                    self.output_csv_f = sys.stdout
+                else:
+                    # written to a temp file, which replaces the output file once done
+                    self.output_csv_f = open(param_dict['out_path'] + '.tmp', 'w', encoding='utf-8')
+                self.writer = csv.DictWriter(self.output_csv_f, out_fields, extrasaction='ignore')
+                self.writer.writeheader()
+            if self.output_format in ['npz', 'both']:
+                self.columns = {field_name: [] for field_name in out_fields}
+
+        # scores of set_index metrics, read from their cached scores matrix
+        set_indices = list(range(chunk['start_idx'], chunk['start_idx'] + len(chunk['rows'])))
+        scores = dict(scores)
+        for metric, metric_params in param_dict['metrics_to_calc'].items():
+            if metric.required_input == 'set_index':
+                start = time.perf_counter()  # the first chunk also calculates (or loads) the whole file's scores
+                scores.update(score_fields(metric_params['instance'], metric_params['field_name'], set_indices))
+                self.report.add_metric(chunk['path'], metric_params['field_name'], time.perf_counter() - start,
+                                       len(set_indices),
+                                       len(set_indices) * metric_params['instance'].pairs_per_set)
+
+        # collect columns - metric scores at full precision
+        if self.columns is not None:
+            for field_name in self.columns.keys():
+                if field_name not in scores:
+                    self.columns[field_name].extend([row[field_name] for row in chunk['rows']])
+            for field_name, field_scores in scores.items():
+                self.columns[field_name].extend(field_scores)
+
+        # write rows - the rows are not used after writing, so they are updated in place
+        if self.writer is not None:
+            for offset, row in enumerate(chunk['rows']):
+                for field_name, value in row.items():
+                    if field_name.startswith(utils.METRIC_FIELD_PREFIX) and type(value) == float:  # read from npz
+                        row[field_name] = '{:.3f}'.format(value)
+                row.update({field_name: '{:.3f}'.format(field_scores[offset])
+                            for field_name, field_scores in scores.items()})
+            self.writer.writerows(chunk['rows'])
+            self.output_csv_f.flush()
+
+    def close(self):
+        if self.path is None:
+            return
+        param_dict = self.csv_dict[self.path]
+
+        # cache stats of the set index metrics of this file
+        metrics_stats = {}
+        for metric_params in param_dict['metrics_to_calc'].values():
+            instance = metric_params.get('instance', None)
+            if instance is not None:
+                metrics_stats[metric_params['field_name']] = {
+                    'pair_dedup': instance.pair_stats,
+                    'embedding_store': instance.embedding_store.stats()
+                    if getattr(instance, 'embedding_store', None) is not None else None}
+
+        if self.output_csv_f not in [None, sys.stdout]:
+            self.output_csv_f.close()
+            os.replace(param_dict['out_path'] + '.tmp', param_dict['out_path'])
+        if self.columns is not None:
+            out_path = utils.npz_path(self.csv_dict[self.path]['out_path'])
+            with open(out_path + '.tmp', 'wb') as npz_f:
+                np.savez(npz_f, **{field_name: to_column(field_name, values)
+                                   for field_name, values in self.columns.items()})
+            os.replace(out_path + '.tmp', out_path)
+        if param_dict['out_path'] != STD_STREAM:
+            # record the fingerprints of the calculated metrics, for incremental runs
+            fingerprints_path = utils.fingerprints_path(param_dict['out_path'])
+            with open(fingerprints_path + '.tmp', 'w') as json_f:
+                json.dump(param_dict['fingerprints'], json_f, indent=4)
+            os.replace(fingerprints_path + '.tmp', fingerprints_path)
+        self.report.close_file(self.path, metrics_stats)
+        self.path = self.output_csv_f = self.writer = self.columns = None
+
+
 def calc_metrics(params):
 
     # choose metrics and configurations
@@ -29,97 +331,184 @@ def calc_metrics(params):
     for metric, metric_params in metrics_dict.items():
         metric_params.update({'field_name': 'metric_' + utils.CamleCase2snake_case(metric_params['name']),
                               'config': deepcopy(metric.default_config)})
+        if params.sampled_pairs > 0 and 'sampled_pairs' in metric_params['config'].keys():
+            metric_params['config'].update({'sampled_pairs': params.sampled_pairs,
+                                            'pair_sampling': params.pair_sampling, 'seed': params.seed})
+        metric_params.update({'fingerprint': metric.fingerprint(metric_params['config']),
+                              'out_fields': [metric_params['field_name']]})
+        if metric_params['config'].get('sampled_pairs', 0) > 0:
+            metric_params['out_fields'].append(metric_params['field_name'] + utils.STANDARD_ERROR_SUFFIX)
         if params.ignore_cache:
             metric_params['config'].update({'ignore_cache': True})
+        if params.cache_dir != '' and 'cache_dir' in metric_params['config'].keys():
+            metric_params['config'].update({'cache_dir': params.cache_dir})
+        if params.max_cache_gb > 0 and 'max_cache_bytes' in metric_params['config'].keys():
+            metric_params['config'].update({'max_cache_bytes': int(params.max_cache_gb * 2 ** 30)})
         # TODO - if one in the future will want to inject non-default metric config, here is the place
 
-    print('#' * 30)
-    print('Metrics parsing and validation done. Will calc the following metrics:')
-    utils.dict_print(metrics_dict)
+    # when writing the results to stdout, the logs go to stderr
+    log_f = sys.stderr if params.output_csv == STD_STREAM or \
+                          (params.input_csv == STD_STREAM and params.output_csv == '') else sys.stdout
+
+    print('#' * 30, file=log_f)
+    print('Metrics parsing and validation done. Will calc the following metrics:', file=log_f)
+    utils.dict_print(metrics_dict, file=log_f)
 
     # parse input csv path
-    csv_dict = {path: {} for path in utils.parse_path_list(params.input_csv,
-                                                           default_path=utils.RAW_DATA_DIR,
-                                                           file_extension='.csv')}
+    if params.input_csv == STD_STREAM:
+        input_paths = [STD_STREAM]
+        if any([metric.required_input == 'set_index' for metric in metrics_dict.keys()]):
+            # set index metrics read their input file on their own - spool stdin to a temp file
+            with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8', delete=False) as spool_f:
+                shutil.copyfileobj(sys.stdin, spool_f)
+            input_paths = [spool_f.name]
+    else:
+        input_paths = utils.parse_path_list(params.input_csv, default_path=utils.RAW_DATA_DIR, file_extension='.csv')
+    assert params.output_csv == '' or len(input_paths) == 1, '--output_csv requires a single input file.'
+    assert params.output_format == 'csv' or STD_STREAM not in [params.output_csv, params.input_csv], \
+        '--output_format {} requires file input and output.'.format(params.output_format)
+    assert not (params.incremental and params.override), '--incremental and --override are exclusive.'
+    csv_dict = {path: {} for path in input_paths}
 
-    # validating files
+    # validating files - reading the header only
     for path, param_dict in csv_dict.items():
-        with open(path, 'r+', encoding='utf-8') as input_csv_f:
-            reader = csv.DictReader(input_csv_f)
-            assert 'sample_id' in reader.fieldnames, '[{}] missing sample_id field'.format(path)
-
-            # validate resp fields
-            resp_fields = [e for e in reader.fieldnames if e.startswith('resp_')
-                           and utils.represents_int(e.replace('resp_', ''))]
-            resp_ints = sorted([int(e.replace('resp_', '')) for e in resp_fields])
-            assert len(resp_fields) > 0, '[{}] missing resp_i fields'.format(path)
-            assert resp_ints == list(range(len(resp_ints))), \
-                '[{}] missing indices in resp_i fields'.format(path)
-            param_dict.update({'samples_per_set': len(resp_fields)})
-
-            # configure num_sets
-            num_sets = 0
-            for _ in reader:
-                num_sets += 1
-            assert num_sets > 0, '[{}] no samples in file'.format(path)
-            param_dict.update({'num_sets': num_sets})
-
-            # configure out_path
-            if utils.RAW_DATA_DIR in path :
-                param_dict.update({'out_path': path.replace(utils.RAW_DATA_DIR, utils.METRICS_DATA_DIR)})
-            else:
-                param_dict.update({'out_path': os.path.join(utils.METRICS_DATA_DIR, os.path.basename(path))})
-            param_dict.update({'run': (not os.path.isfile(param_dict['out_path']) or params.override)})
-
-            # configure local metrics
-            local_metrics = deepcopy({metric: metric_params for metric, metric_params in metrics_dict.items()
-                                      if metric_params['field_name'] not in reader.fieldnames})
-            for metric, metric_params in local_metrics.items():
-                if 'input_path' in metric_params['config'].keys():
-                    metric_params['config']['input_path'] = path
-                if 'num_sets' in metric_params['config'].keys():
-                    metric_params['config']['num_sets'] = param_dict['num_sets']
-                if 'samples_per_set' in metric_params['config'].keys():
-                    metric_params['config']['samples_per_set'] = param_dict['samples_per_set']
+        if path == STD_STREAM:
+            reader = csv.DictReader(sys.stdin)
+            param_dict.update({'reader': reader})  # keep reading the rows from the same stream
+            fieldnames = reader.fieldnames
+        else:
+            with open(path, 'r+', encoding='utf-8') as input_csv_f:
+                fieldnames = csv.DictReader(input_csv_f).fieldnames
+        assert fieldnames is not None, '[{}] no samples in file'.format(path)
+        assert 'sample_id' in fieldnames, '[{}] missing sample_id field'.format(path)
 
+        # validate resp fields
+        resp_fields = [e for e in fieldnames if e.startswith('resp_')
+                       and utils.represents_int(e.replace('resp_', ''))]
+        resp_ints = sorted([int(e.replace('resp_', '')) for e in resp_fields])
+        assert len(resp_fields) > 0, '[{}] missing resp_i fields'.format(path)
+        assert resp_ints == list(range(len(resp_ints))), \
+            '[{}] missing indices in resp_i fields'.format(path)
+        param_dict.update({'samples_per_set': len(resp_fields)})
+
+        # configure out_path
+        if params.output_csv != '':
+            param_dict.update({'out_path': params.output_csv})
+        elif params.input_csv == STD_STREAM:
+            param_dict.update({'out_path': STD_STREAM})
+        elif utils.RAW_DATA_DIR in path :
+            param_dict.update({'out_path': path.replace(utils.RAW_DATA_DIR, utils.METRICS_DATA_DIR)})
+        else:
+            param_dict.update({'out_path': os.path.join(utils.METRICS_DATA_DIR, os.path.basename(path))})
+        out_paths = {'csv': [param_dict['out_path']], 'npz': [utils.npz_path(param_dict['out_path'])],
+                     'both': [param_dict['out_path'], utils.npz_path(param_dict['out_path'])]}[params.output_format]
+        outputs_exist = param_dict['out_path'] != STD_STREAM and all([os.path.isfile(p) for p in out_paths])
+        param_dict.update({'out_paths': out_paths, 'in_path': path, 'fingerprints': {},
+                           'run': not outputs_exist or params.override})
+
+        # incremental mode - read the existing output (the npz if there is one, for its full precision metrics, with
+        # the text fields of the csv if there is one too), and calc only the metrics it is missing, or whose recorded
+        # fingerprint changed (stale)
+        stale_fields = []
+        if params.incremental and outputs_exist:
+            param_dict['in_path'] = out_paths[-1]
+            if len(out_paths) > 1:
+                param_dict['in_csv_path'] = out_paths[0]
+            fieldnames = read_fieldnames(param_dict['in_path'])
+            if os.path.isfile(utils.fingerprints_path(param_dict['out_path'])):
+                with open(utils.fingerprints_path(param_dict['out_path']), 'r+', encoding='utf-8') as json_f:
+                    param_dict['fingerprints'] = json.load(json_f)
+            recorded = param_dict['fingerprints']  # fields without a record (e.g. older outputs) are kept
+            stale_fields = [metric_params['field_name'] for metric_params in metrics_dict.values()
+                            if recorded.get(metric_params['field_name'], metric_params['fingerprint']) !=
+                            metric_params['fingerprint']]
+
+        # configure local metrics
+        local_metrics = deepcopy({metric: metric_params for metric, metric_params in metrics_dict.items()
+                                  if metric_params['field_name'] not in fieldnames or
+                                  metric_params['field_name'] in stale_fields})
+        param_dict['fingerprints'].update({metric_params['field_name']: metric_params['fingerprint']
+                                           for metric_params in local_metrics.values()})
+        if params.incremental and outputs_exist:
+            param_dict['run'] = len(local_metrics) > 0
+        if not param_dict['run']:
+            local_metrics = {}  # skipped file - its rows are not counted, nor its cache keys hashed
+        for metric, metric_params in local_metrics.items():
+            if 'input_path' in metric_params['config'].keys():
+                metric_params['config']['input_path'] = path
+            if 'num_sets' in metric_params['config'].keys():
+                # deferred - only metrics reading the whole input file on their own need it in advance
+                if 'num_sets' not in param_dict.keys():
+                    param_dict.update({'num_sets': count_rows(path)})
+                    assert param_dict['num_sets'] > 0, '[{}] no samples in file'.format(path)
+                metric_params['config']['num_sets'] = param_dict['num_sets']
+            if 'samples_per_set' in metric_params['config'].keys():
+                metric_params['config']['samples_per_set'] = param_dict['samples_per_set']
+
+            # response set metrics are instanced once per worker, see init_worker
+            if metric.required_input == 'set_index':
                 metric_params.update({'instance': metric(metric_params['config'])})
-            param_dict.update({'metrics_to_calc': local_metrics})
+        param_dict.update({'metrics_to_calc': local_metrics})
 
-    print('#' * 30)
-    print('Parsing and validation done. Will calc metrics for the following files:')
+    print('#' * 30, file=log_f)
+    print('Parsing and validation done. Will calc metrics for the following files:', file=log_f)
     for k, v in csv_dict.items():
         if v['run']:
-            print(k + ' -> ' + v['out_path'])
+            print(k + ' -> ' + ', '.join(v['out_paths']), file=log_f)
 
-    # calc metrics for each file
-    for path, param_dict in csv_dict.items():
-        if param_dict['run']:
-            # handle files
-            out_dir = os.path.dirname(param_dict['out_path'])
-            if not os.path.exists(out_dir):
-                os.makedirs(out_dir)
+    # calc metrics for each file - response set metrics are calculated over chunks of rows by a pool of worker
+    # processes, while set index metrics (reading pre-calculated scores) are calculated here, in order, when writing
+    response_set_metrics = {metric_params['field_name']: (metric, metric_params['config'])
+                            for metric, metric_params in metrics_dict.items()
+                            if metric.required_input == 'response_set'}
+    pool = None
+    if params.workers > 1:
+        pool = multiprocessing.Pool(params.workers, initializer=init_worker, initargs=(response_set_metrics,))
+    else:
+        init_worker(response_set_metrics)
+
+    def calc_chunk_async(chunk):
+        param_dict = csv_dict[chunk['path']]
+        field_names = [metric_params['field_name'] for metric, metric_params in param_dict['metrics_to_calc'].items()
+                       if metric.required_input == 'response_set']
+        resp_sets = [[in_row['resp_{}'.format(i)] for i in range(param_dict['samples_per_set'])]
+                     for in_row in chunk['rows']]
+        if pool is None:
+            return calc_chunk(field_names, resp_sets)
+        return pool.apply_async(calc_chunk, (field_names, resp_sets))
+
+    def write_chunk(chunk, result):
+        scores, stats = result if pool is None else result.get()
+        for field_name, (sec, num_pairs) in stats.items():
+            report.add_metric(chunk['path'], field_name, sec, len(chunk['rows']), num_pairs)
+        chunk_writer.write(chunk, scores)
+
+    report = RunReport()
+    chunk_writer = ChunkWriter(csv_dict, params.output_format, report)
+    pending = deque()  # chunks in process, in order
+    for chunk in iter_chunks(csv_dict, params.chunk_size):
+        report.add_rows(chunk['path'], len(chunk['rows']))
+        pending.append((chunk, calc_chunk_async(chunk)))
+        while len(pending) > 2 * (params.workers - 1):
+            write_chunk(*pending.popleft())
+    while len(pending) > 0:
+        write_chunk(*pending.popleft())
+    chunk_writer.close()
 
-            # handle reader and writer
-            input_csv_f = open(path, 'r+', encoding='utf-8')
-            # TODO - check if outfile exists
-            output_csv_f = open(param_dict['out_path'], 'w', encoding='utf-8')
-            reader = csv.DictReader(input_csv_f)
-            out_fields = reader.fieldnames + [metric_params['field_name']
-                                              for metric_params in param_dict['metrics_to_calc'].values()]
-            writer = csv.DictWriter(output_csv_f, out_fields)
-            writer.writeheader()
-
-            # write rows
-            for idx, in_row in enumerate(reader):
-                resp_set = [in_row['resp_{}'.format(i)] for i in range(param_dict['samples_per_set'])]
-                out_row = deepcopy(in_row)
-                for metric, metric_params in param_dict['metrics_to_calc'].items():
-                    metric_input = idx if metric.required_input == 'set_index' else resp_set
-                    out_row.update({metric_params['field_name']: '{:.3f}'.format(metric_params['instance'](metric_input))})
-                writer.writerow(out_row)
-
-            input_csv_f.close()
-            output_csv_f.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # run report
+    run_report = report.as_dict(params.workers)
+    report.print_summary(run_report, file=log_f)
+    if params.report != '':
+        with open(params.report + '.tmp', 'w') as json_f:
+            json.dump(run_report, json_f, indent=4)
+        os.replace(params.report + '.tmp', params.report)
+
+    if params.input_csv == STD_STREAM and input_paths != [STD_STREAM]:
+        os.remove(input_paths[0])  # stdin spool file
 
 
 if __name__ == '__main__':
@@ -130,13 +519,54 @@ if __name__ == '__main__':
     # main parameters
     parser.add_argument("--input_csv", type=str, default='',
                         help='Input results csv file. Support multiple, comma separated, or dirs. '
-                             'By default, will handle all files in ./data/raw/')
+                             'By default, will handle all files in ./data/raw/. Use - for reading from stdin.')
+    parser.add_argument("--output_csv", type=str, default='',
+                        help='Output csv file, for a single input file only. Use - for writing to stdout. '
+                             'By default, will write to ./data/with_metrics/ (or to stdout when reading from stdin).')
+    parser.add_argument("--incremental", action='store_true',
+                        help='Add to existing output files only the metrics they miss, or whose config / version '
+                             'changed since calculated, instead of skipping (or with --override, recalculating) them.')
+    parser.add_argument("--output_format", type=str, default='csv', choices=['csv', 'npz', 'both'],
+                        help='csv - text, with 3 decimal digits. npz - columnar numpy arrays next to the csv path, '
+                             'with full precision metrics and typed labels (fast to load by run_experiments.py).')
     parser.add_argument("--metrics", type=str, default='',
                         help='Metrics to calculate (by their class name). Support multiple, comma separated. '
                              'By default, will use all available metrics from diversity_metrics.py')
+    parser.add_argument("--sampled_pairs", type=int, default=0,
+                        help='Estimate the pairwise similarity metrics (e.g. AveragedCosineSimilarity, BertScore) from '
+                             'this number of sampled pairs per set, instead of all the pairs, and add the standard '
+                             'errors of the estimates as [metric]_se fields. By default (0), will score all the pairs.')
+    parser.add_argument("--pair_sampling", type=str, default='random', choices=utils.PAIR_SAMPLINGS,
+                        help='random - uniformly. stratified - one pair from each of sampled_pairs equal strata of '
+                             'the pairs, covering all the responses evenly.')
+    parser.add_argument("--seed", type=int, default=0,
+                        help='Seed of the sampled pairs (together with the responses of each set).')
     parser.add_argument("--ignore_cache", action='store_true', help='If true, will ignore existing cache file.')
+    parser.add_argument("--cache_dir", type=str, default='',
+                        help='Directory of the similarity scores cache, can be shared by concurrent runs. '
+                             'By default, will use a directory under the system temp dir.')
+    parser.add_argument("--max_cache_gb", type=float, default=0,
+                        help='Size limit of the cache dir, least recently used files are evicted. By default, 10GB.')
     parser.add_argument("--override", action='store_true', help='If true, will override existing files.')
+    parser.add_argument("--workers", type=int, default=1,
+                        help='Number of worker processes calculating the response set metrics '
+                             '(e.g. AveragedDistinctNgrams, AveragedCosineSimilarity).')
+    parser.add_argument("--chunk_size", type=int, default=500,
+                        help='Number of rows sent to a worker at once.')
+
+    parser.add_argument("--report", type=str, default='',
+                        help='Path of a json report of the run - time, rows/sec and pairs/sec of each metric and file, '
+                             'cache stats and peak memory.')
+    parser.add_argument("--profile", type=str, default='',
+                        help='Path for cProfile stats of the run (of the main process - set --workers 1 to profile '
+                             'the response set metrics too). The top functions are printed to stderr.')
 
     params = parser.parse_args()
     utils.download_and_place_data()
-    calc_metrics(params)
\ No newline at end of file
+    if params.profile != '':
+        profiler = cProfile.Profile()
+        profiler.runcall(calc_metrics, params)
+        profiler.dump_stats(params.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+    else:
+        calc_metrics(params)
\ No newline at end of file
@@ -1,4 +1,3 @@
-from scipy.spatial.distance import cosine
 import numpy as np
 
 # local
@@ -7,11 +6,15 @@ import utils
 
 class CosineSimilarity(metric.SimilarityMetric):
 
+    backend_modules = ['scipy.sparse', 'scipy.spatial.distance']
+
     def __init__(self, config):
         super().__init__(config)
 
         # validate config
         self.uint_assert('n')
+        self.config.setdefault('ngram_backend', 'tuple')
+        assert self.config['ngram_backend'] in utils.NGRAM_BACKENDS
 
     def ngram_cosine_distance(selff, ngram1, ngram2):
         """
@@ -32,8 +35,86 @@ class CosineSimilarity(metric.SimilarityMetric):
             for n_gram in [ngram1, ngram2]:
                 vectors.append([n_gram.count(e) for e in n_space])
 
+            from scipy.spatial.distance import cosine
             return cosine(vectors[0], vectors[1])  # uv/|u||v|
 
+    def ngram_cosine_similarity_matrix(self, ngram_lists):
+        """
+        Calc cosine similarity between all (ngram_lists[i], ngram_lists[j]) at once in the n-gram space,
+        using a single sparse count matrix product.
+        :param ngram_lists: list of lists of ngrams
+        :return: [len(ngram_lists), len(ngram_lists)] similarity matrix
+        """
+        n_space = {}
+        rows, cols = [], []
+        for row, ngrams in enumerate(ngram_lists):
+            for ngram in ngrams:
+                cols.append(n_space.setdefault(ngram, len(n_space)))
+                rows.append(row)
+        return self.count_matrix_cosine_similarity(rows, cols, shape=(len(ngram_lists), len(n_space)))
+
+    def hashed_ngram_cosine_similarity_matrix(self, token_ids, n):
+        """
+        Same as ngram_cosine_similarity_matrix, for the 'hash' backend.
+        :param token_ids: utils.TokenIds of the responses
+        """
+        hashed_ngrams, rows = utils.token_ids_to_hashed_ngrams(token_ids, n=n)
+        n_space, cols = np.unique(hashed_ngrams, return_inverse=True)
+        return self.count_matrix_cosine_similarity(rows, cols, shape=(len(token_ids.lengths), len(n_space)))
+
+    def count_matrix(self, rows, cols, shape):
+        from scipy.sparse import csr_matrix
+
+        # vectorize - duplicated (row, col) entries are summed into counts
+        return csr_matrix((np.ones(len(cols)), (rows, cols)), shape=shape)
+
+    @staticmethod
+    def counts_cosine_similarities(uv, uu, vv):
+        """
+        1 - cosine distance from the (exact, integer valued) count products, in the order of operations of scipy's
+        cosine (1 - uv / sqrt(uu * vv), clipped), so the scores are the same as ngram_cosine_distance's to the bit.
+        Pairs without a common n-gram are 0., as in its acceleration step.
+        """
+        uv, uu, vv = [np.asarray(e, dtype=np.float64).reshape(-1) for e in [uv, uu, vv]]
+        similarities = np.zeros(len(uv))
+        common = uv > 0
+        similarities[common] = 1 - np.clip(1.0 - uv[common] / np.sqrt(uu[common] * vv[common]), 0.0, 2.0)
+        return similarities
+
+    def count_matrix_cosine_similarity(self, rows, cols, shape):
+        counts = self.count_matrix(rows, cols, shape)
+        products = (counts @ counts.T).toarray()  # uv of all pairs, uu on the diagonal
+        squares = np.diag(products)
+        return self.counts_cosine_similarities(products, np.repeat(squares, len(squares)),
+                                               np.tile(squares, len(squares))).reshape(products.shape)
+
+    def batch_ngram_cosine_similarities(self, rows, cols, shape, set_sizes):
+        """
+        Calc the cosine similarities of the (i, j), j < i, pairs within each set, for many sets at once.
+        The n-gram space of each set is disjoint from the others' (cols), so the product of the count matrix is block
+        diagonal and only holds the within-set products.
+        :param rows: response index of each n-gram, over all sets
+        :param cols: n-gram space index of each n-gram
+        :param set_sizes: list of the number of responses in each set
+        :return: list of similarity arrays, one per set
+        """
+        counts = self.count_matrix(rows, cols, shape)
+        products = (counts @ counts.T).tocsr()  # uv
+        squares = counts.multiply(counts).sum(axis=1).A1  # uu
+
+        # (i, j), j < i, pairs of each set, in global response indices
+        offsets = np.cumsum(set_sizes) - set_sizes
+        pairs = [np.tril_indices(size, -1) for size in set_sizes]
+        pair_rows = np.concatenate([offset + i for offset, (i, _) in zip(offsets, pairs)] + [np.zeros(0, dtype=int)])
+        pair_cols = np.concatenate([offset + j for offset, (_, j) in zip(offsets, pairs)] + [np.zeros(0, dtype=int)])
+        similarities = np.zeros(0)
+        if len(pair_rows) > 0:
+            similarities = self.counts_cosine_similarities(products[pair_rows, pair_cols], squares[pair_rows],
+                                                           squares[pair_cols])
+        if len(pairs) == 0:
+            return []
+        return np.split(similarities, np.cumsum([len(i) for i, _ in pairs])[:-1])
+
     def ngram_cosine_similarity(self, str1, str2, n):
         ngrams = utils.lines_to_ngrams([str1, str2], n)
         return 1 - self.ngram_cosine_distance(ngrams[0], ngrams[1])
@@ -41,3 +122,75 @@ class CosineSimilarity(metric.SimilarityMetric):
     def __call__(self, resp_a, resp_b):
         super().__call__(resp_b, resp_b)
         return self.ngram_cosine_similarity(resp_a, resp_b, n=self.config['n'])
+
+    def tokenize(self, response_set):
+        return utils.tokenize(response_set, ngram_backend=self.config['ngram_backend'])
+
+    def pairwise_similarities_from_tokens(self, token_lists, n):
+        if self.config['ngram_backend'] == 'hash':
+            similarity_matrix = self.hashed_ngram_cosine_similarity_matrix(token_lists, n=n)
+        else:
+            similarity_matrix = self.ngram_cosine_similarity_matrix(utils.tokens_to_ngrams(token_lists, n=n))
+        return similarity_matrix[np.tril_indices(len(similarity_matrix), -1)].tolist()
+
+    def pairwise_similarities(self, response_set):
+        return self.pairwise_similarities_from_tokens(self.tokenize(response_set), n=self.config['n'])
+
+    def pair_similarities_from_tokens(self, token_lists, rows, cols, n):
+        """
+        Calc the cosine similarities of the given (i, j) pairs of a response set only, without the full similarity
+        matrix, for the sampled pairs mode.
+        :return: similarity array
+        """
+        if self.config['ngram_backend'] == 'hash':
+            hashed_ngrams, ngram_rows = utils.token_ids_to_hashed_ngrams(token_lists, n=n)
+            n_space, ngram_cols = np.unique(hashed_ngrams, return_inverse=True)
+            shape = (len(token_lists.lengths), len(n_space))
+        else:
+            n_space = {}
+            ngram_rows, ngram_cols = [], []
+            for row, ngrams in enumerate(utils.tokens_to_ngrams(token_lists, n=n)):
+                for ngram in ngrams:
+                    ngram_cols.append(n_space.setdefault(ngram, len(n_space)))
+                    ngram_rows.append(row)
+            shape = (len(token_lists), len(n_space))
+        if len(rows) == 0:
+            return np.zeros(0)
+        counts = self.count_matrix(ngram_rows, ngram_cols, shape)
+        squares = counts.multiply(counts).sum(axis=1).A1
+        return self.counts_cosine_similarities(counts[rows].multiply(counts[cols]).sum(axis=1), squares[rows],
+                                               squares[cols])
+
+    def pair_similarities(self, response_set, rows, cols):
+        return self.pair_similarities_from_tokens(self.tokenize(response_set), rows, cols, n=self.config['n']).tolist()
+
+    def tokenize_batch(self, response_sets):
+        token_lists = [self.tokenize(response_set) for response_set in response_sets]
+        if self.config['ngram_backend'] == 'hash':
+            return utils.concat_token_ids(token_lists)
+        return token_lists
+
+    def batch_pairwise_similarities_from_tokens(self, batch_tokens, n):
+        if self.config['ngram_backend'] == 'hash':
+            hashed_ngrams, rows = utils.token_ids_to_hashed_ngrams(batch_tokens.token_ids, n=n)
+            cols = utils.group_unique_inverse(hashed_ngrams, batch_tokens.set_ids[rows])  # n-gram space per set
+            shape = (len(batch_tokens.set_ids), cols.max() + 1 if len(cols) > 0 else 0)
+            set_sizes = np.bincount(batch_tokens.set_ids, minlength=batch_tokens.num_sets)
+        else:
+            rows, cols = [], []
+            row = col_offset = 0
+            for token_lists in batch_tokens:
+                n_space = {}  # n-gram space per set, placed after the previous sets' columns
+                for ngrams in utils.tokens_to_ngrams(token_lists, n=n):
+                    for ngram in ngrams:
+                        cols.append(col_offset + n_space.setdefault(ngram, len(n_space)))
+                        rows.append(row)
+                    row += 1
+                col_offset += len(n_space)
+            shape = (row, col_offset)
+            set_sizes = [len(token_lists) for token_lists in batch_tokens]
+        return self.batch_ngram_cosine_similarities(rows, cols, shape, set_sizes)
+
+    def batch_pairwise_similarities(self, response_sets):
+        return [similarities.tolist() for similarities in
+                self.batch_pairwise_similarities_from_tokens(self.tokenize_batch(response_sets), n=self.config['n'])]
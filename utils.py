@@ -1,8 +1,8 @@
 import os
-import requests
 import re
-from tqdm import tqdm
+import hashlib
 import zipfile
+from collections import namedtuple
 import numpy as np
 
 # consts
@@ -15,16 +15,27 @@ LABEL_VAL_FIELD = 'label_value'
 LABEL_NAME_FIELD = 'label_name'
 LABEL_PREFIX = 'label_'
 METRIC_FIELD_PREFIX = 'metric_'
+NGRAM_BACKENDS = ['tuple', 'hash']
+PAIR_SAMPLINGS = ['random', 'stratified']
+STANDARD_ERROR_SUFFIX = '_se'  # field name suffix of the standard errors of sampled pairs estimates
+STABLE_HASH_BASE = 0x9E3779B97F4A7C15  # odd 64-bit multiplier of the n-gram rolling hash of stable_token_ids
+MAX_TOKEN_HASHES = 2 ** 20  # size bound of the token hashes cache of stable_token_ids
 
+# token lists of a response set, encoded to ints: concatenated token ids, number of tokens per response, vocabulary size
+# (None for 64-bit token hashes, see stable_token_ids)
+TokenIds = namedtuple('TokenIds', ['ids', 'lengths', 'vocab_size'])
+# TokenIds of the responses of many response sets, the set index of each response, number of sets
+BatchTokenIds = namedtuple('BatchTokenIds', ['token_ids', 'set_ids', 'num_sets'])
 
-def dict_print(d, indent=0):
+
+def dict_print(d, indent=0, file=None):
     # code from https://stackoverflow.com/questions/3229419/how-to-pretty-print-nested-dictionaries
     for key, value in d.items():
-        print('\t' * indent + str(key))
+        print('\t' * indent + str(key), file=file)
         if isinstance(value, dict):
-            dict_print(value, indent+1)
+            dict_print(value, indent+1, file=file)
         else:
-            print('\t' * (indent+1) + str(value))
+            print('\t' * (indent+1) + str(value), file=file)
 
 
 def parse_path_list(path_str, default_path, file_extension='.csv'):
@@ -46,6 +57,16 @@ def parse_path_list(path_str, default_path, file_extension='.csv'):
     return csv_list
 
 
+def npz_path(csv_path):
+    # path of the columnar npz version of a csv file
+    return os.path.splitext(csv_path)[0] + '.npz'
+
+
+def fingerprints_path(csv_path):
+    # path of the metric fingerprints sidecar of a with_metrics file
+    return os.path.splitext(csv_path)[0] + '.metrics.json'
+
+
 def CamleCase2snake_case(string):
     # code from https://stackoverflow.com/questions/1175208/elegant-python-function-to-convert-camelcase-to-snake-case
     return re.sub(r'(?<!^)(?=[A-Z])', '_', string).lower()
@@ -61,12 +82,286 @@ def represents_int(s):
         return False
 
 
+def lines_to_tokens(lines):
+    return [[e for e in s.replace('.','').replace('\n','').split(' ') if e != ''] for s in lines]
+
+
+def tokens_to_ngrams(token_lists, n=3):
+    return [[tuple(words[i:i + n]) for i in range(len(words) - n + 1)] for words in token_lists]
+
+
 def lines_to_ngrams(lines, n=3):
-    ngrams = []
-    for s in lines:
-        words = [e for e in s.replace('.','').replace('\n','').split(' ') if e != '']
-        ngrams.append([tuple(words[i:i + n]) for i in range(len(words) - n + 1)])
-    return ngrams
+    return tokens_to_ngrams(lines_to_tokens(lines), n=n)
+
+
+def tokens_to_ids(token_lists):
+    vocab = {}
+    ids = np.fromiter((vocab.setdefault(e, len(vocab)) for words in token_lists for e in words), dtype=np.uint64)
+    lengths = np.array([len(words) for words in token_lists], dtype=np.int64)
+    return TokenIds(ids, lengths, len(vocab))
+
+
+def token_ids_to_hashed_ngrams(token_ids, n=3):
+    """
+    Encode the n-grams of all responses as 64-bit ints: sum(id_k * vocab_size^(n-1-k)), collision free as long as
+    vocab_size^n < 2^64. Otherwise, the unique n-grams are numbered instead (still collision free, but only comparable
+    within the call). For 64-bit token hashes (stable_token_ids), the codes are a rolling hash, stable across calls.
+    :param token_ids: TokenIds
+    :return: uint64 array of n-gram codes, int array with the response index of each n-gram
+    """
+    ids, lengths = token_ids.ids, token_ids.lengths
+    num_windows = max(len(ids) - n + 1, 0)
+    if token_ids.vocab_size is not None and max(token_ids.vocab_size, 1) ** n >= 2 ** 64:
+        windows = np.stack([ids[k:k + num_windows] for k in range(n)], axis=1)
+        hashes = np.unique(windows, axis=0, return_inverse=True)[1].reshape(-1).astype(np.uint64)
+    else:
+        base = np.uint64(STABLE_HASH_BASE if token_ids.vocab_size is None else max(token_ids.vocab_size, 1))
+        hashes = np.zeros(num_windows, dtype=np.uint64)
+        for k in range(n):
+            hashes = hashes * base + ids[k:k + num_windows]  # uint64 arithmetic wraps around (hashed ids only)
+
+    # drop windows crossing a response boundary
+    owners = np.repeat(np.arange(len(lengths)), lengths)[:num_windows]
+    starts = np.cumsum(lengths) - lengths
+    valid = np.arange(num_windows) - starts[owners] <= lengths[owners] - n
+    return hashes[valid], owners[valid]
+
+
+def stable_token_ids(token_lists, token_hashes):
+    """
+    Same as tokens_to_ids, with 64-bit hashes of the tokens as ids instead of vocabulary indices, so that the n-gram
+    codes of token_ids_to_hashed_ngrams are the same across calls (e.g. for online accumulators).
+    :param token_hashes: dict, token -> hash cache kept by the caller (cleared when it grows over MAX_TOKEN_HASHES)
+    :return: TokenIds, with vocab_size None (the n-gram codes are a rolling hash, see token_ids_to_hashed_ngrams)
+    """
+    if len(token_hashes) > MAX_TOKEN_HASHES:
+        token_hashes.clear()
+
+    def token_hash(token):
+        if token not in token_hashes:
+            digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+            token_hashes[token] = int.from_bytes(digest, 'little')
+        return token_hashes[token]
+
+    ids = np.fromiter((token_hash(e) for words in token_lists for e in words), dtype=np.uint64)
+    lengths = np.array([len(words) for words in token_lists], dtype=np.int64)
+    return TokenIds(ids, lengths, None)
+
+
+def mix64(hashes):
+    # splitmix64 finalizer - spreads the bits of 64-bit codes (e.g. n-gram rolling hashes) uniformly
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+class HyperLogLog:
+    """
+    Approximate distinct counter of 64-bit codes in bounded memory - 2 ** precision one byte registers, with a relative
+    standard error of about 1.04 / sqrt(2 ** precision) (Flajolet et al. 2007, with linear counting for small counts).
+
+    usage:
+        hll = HyperLogLog(precision=14)
+        hll.update(codes)  # uint64 array, e.g. hashed n-grams
+        hll.count()
+    """
+
+    def __init__(self, precision=14):
+        assert type(precision) == int and 4 <= precision <= 18, 'Required: 4 <= precision(int) <= 18'
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype=np.uint8)
+
+    def update(self, codes):
+        hashes = mix64(codes)
+        buckets = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = hashes << np.uint64(self.precision)  # the remaining bits, left aligned
+
+        # rank - the position of the first 1 bit of the remaining bits (leading zeros + 1), in exact 32-bit halves
+        high = (rest >> np.uint64(32)).astype(np.float64)
+        low = (rest & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        with np.errstate(divide='ignore'):
+            leading_zeros = np.where(high > 0, 31 - np.floor(np.log2(high)),
+                                     np.where(low > 0, 63 - np.floor(np.log2(low)), 64))
+        ranks = np.minimum(leading_zeros + 1, 64 - self.precision + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def merge(self, other):
+        assert other.precision == self.precision
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        num_registers = len(self.registers)
+        alpha = 0.7213 / (1. + 1.079 / num_registers)
+        estimate = alpha * num_registers ** 2 / np.sum(np.power(2., -self.registers.astype(np.float64)))
+        num_zeros = int(np.sum(self.registers == 0))
+        if estimate <= 2.5 * num_registers and num_zeros > 0:
+            estimate = num_registers * np.log(num_registers / num_zeros)  # linear counting
+        return float(estimate)
+
+
+def concat_token_ids(token_ids_list):
+    """
+    Concatenate the TokenIds of many response sets, each keeping its own vocabulary (n-grams of different sets are
+    never compared, so the ids need not be shared, and the vocabulary size stays that of the largest set).
+    :param token_ids_list: list of TokenIds, one per set
+    :return: BatchTokenIds
+    """
+    token_ids = TokenIds(np.concatenate([e.ids for e in token_ids_list] + [np.zeros(0, dtype=np.uint64)]),
+                         np.concatenate([e.lengths for e in token_ids_list] + [np.zeros(0, dtype=np.int64)]),
+                         max([e.vocab_size for e in token_ids_list] + [0]))
+    set_ids = np.repeat(np.arange(len(token_ids_list)), [len(e.lengths) for e in token_ids_list])
+    return BatchTokenIds(token_ids, set_ids, len(token_ids_list))
+
+
+def group_unique_inverse(values, groups):
+    """
+    Number the unique (group, value) pairs, e.g. the unique n-grams of each response set.
+    :param values: int array
+    :param groups: int array of the same length
+    :return: int array with the index of each element's (group, value) pair, in 0..num_unique_pairs-1
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    values_range = int(values.max()) + 1
+    if values_range * (int(groups.max()) + 1) <= 2 ** 64:
+        # pack each pair to a single uint64 key - one sort instead of a (slower) lexsort
+        keys = groups.astype(np.uint64) * np.uint64(values_range) + values.astype(np.uint64)
+        return np.unique(keys, return_inverse=True)[1].reshape(-1)
+
+    order = np.lexsort((values, groups))
+    sorted_values, sorted_groups = values[order], groups[order]
+    is_new = np.ones(len(order), dtype=bool)
+    is_new[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_groups[1:] != sorted_groups[:-1])
+    inverse = np.empty(len(order), dtype=np.int64)
+    inverse[order] = np.cumsum(is_new) - 1
+    return inverse
+
+
+def tokenize(lines, ngram_backend='tuple'):
+    token_lists = lines_to_tokens(lines)
+    return tokens_to_ids(token_lists) if ngram_backend == 'hash' else token_lists
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for e in iterable:
+        batch.append(e)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def num_tokens(s):
+    # approximated by white spaces, independent of any model's tokenizer
+    return len(s.split())
+
+
+def length_bucketed_batches(lengths, max_batch_tokens, max_batch_size):
+    """
+    Group items of similar length to batches, so that little padding is wasted.
+    Items are sorted by length, and each batch is filled while its padded size (batch size * longest item) is within
+    max_batch_tokens and it has up to max_batch_size items.
+    :param lengths: list of item lengths (e.g. number of tokens)
+    :return: list of batches, each is a list of item indices
+    """
+    batches = []
+    batch = []
+    for idx in np.argsort(lengths, kind='stable').tolist():
+        if len(batch) > 0 and ((len(batch) + 1) * max(lengths[idx], 1) > max_batch_tokens or
+                               len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def length_bucketed_map(batch_func, items, lengths, max_batch_tokens, max_batch_size):
+    """
+    Apply a batch function on length bucketed batches (see length_bucketed_batches) and scatter the results back.
+    :param batch_func: function (list of items) -> list of results
+    :param items: list of items
+    :param lengths: list of item lengths (e.g. number of tokens)
+    :return: list of results, in the original order of items
+    """
+    results = [None] * len(items)
+    for batch in length_bucketed_batches(lengths, max_batch_tokens, max_batch_size):
+        for idx, result in zip(batch, batch_func([items[i] for i in batch])):
+            results[idx] = result
+    return results
+
+
+def num_pairs(num_samples):
+    return num_samples * (num_samples - 1) // 2  # choose(num_samples, 2)
+
+
+def pair_indices_to_pairs(pair_indices):
+    """
+    Map indices in the (i, j), j < i, pairs ordering [(1, 0), (2, 0), (2, 1), (3, 0), ...] to their pairs.
+    :param pair_indices: int array
+    :return: (i array, j array)
+    """
+    pair_indices = np.asarray(pair_indices, dtype=np.int64)
+    rows = np.floor((1. + np.sqrt(1. + 8. * pair_indices)) / 2.).astype(np.int64)
+    rows -= rows * (rows - 1) // 2 > pair_indices  # float rounding
+    rows += (rows + 1) * rows // 2 <= pair_indices
+    return rows, pair_indices - rows * (rows - 1) // 2
+
+
+def response_set_rng(response_set, seed):
+    # a generator seeded by the responses, so a set gets the same samples regardless of its position or chunking
+    digest = hashlib.sha256('\x1f'.join(response_set).encode('utf-8')).digest()
+    return np.random.default_rng([seed, int.from_bytes(digest[:8], 'little')])
+
+
+def sample_pairs(num_samples, num_sampled, rng, pair_sampling='random'):
+    """
+    Sample pairs of a response set without replacement, for estimating its mean pairwise similarity.
+    random - uniformly. stratified - one pair from each of num_sampled equal strata of the pairs ordering, so the
+    sampled pairs cover all the responses evenly.
+    :param num_samples: number of responses in the set
+    :param num_sampled: number of pairs to sample - all the pairs if it is not smaller than choose(num_samples, 2)
+    :param rng: numpy Generator, e.g. response_set_rng
+    :return: (i array, j array), j < i, in the ordering of pair_indices_to_pairs
+    """
+    assert pair_sampling in PAIR_SAMPLINGS
+    total = num_pairs(num_samples)
+    if num_sampled >= total:
+        return np.tril_indices(num_samples, -1)
+    if pair_sampling == 'random':
+        pair_indices = np.sort(rng.choice(total, size=num_sampled, replace=False))
+    else:
+        bounds = np.arange(num_sampled + 1, dtype=np.int64) * total // num_sampled
+        pair_indices = bounds[:-1] + (rng.random(num_sampled) * (bounds[1:] - bounds[:-1])).astype(np.int64)
+    return pair_indices_to_pairs(pair_indices)
+
+
+def pairs_responses(rows, cols):
+    """
+    :param rows: i of each pair
+    :param cols: j of each pair
+    :return: (responses, rows, cols) - the indices of the responses in the pairs, and the pairs over these responses
+    """
+    responses, inverse = np.unique(np.concatenate([rows, cols]).astype(np.int64), return_inverse=True)
+    return responses, inverse[:len(rows)], inverse[len(rows):]
+
+
+def mean_standard_error(values, population_size):
+    """
+    Standard error of the mean of values sampled uniformly without replacement out of population_size values, with the
+    finite population correction. For stratified samples it is only an approximation (it ignores the strata).
+    :return: float, nan for less than 2 values (of a larger population)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) >= population_size:
+        return 0.
+    if len(values) < 2:
+        return np.nan
+    return float(np.std(values, ddof=1) / np.sqrt(len(values)) * np.sqrt(1. - len(values) / population_size))
 
 
 def stringify_keys(d):
@@ -98,6 +393,8 @@ def stringify_keys(d):
 def download_and_place_data():
 
     if not os.path.exists(DATA_DIR):
+        import requests
+        from tqdm import tqdm
 
         url = 'http://diversity-eval.s3-us-west-2.amazonaws.com/data.zip'
         target_zip = 'data.zip'
@@ -117,28 +414,118 @@ def download_and_place_data():
 
 def optimal_classification_accuracy(group_1, group_2):
     """
-    find optimal classification accuracy in 1d feature space by exhaustively checking all separators.
+    find optimal classification accuracy in 1d feature space by checking all separators.
+    each sample (+1e-5) is a separator, and the samples on each side of all separators are counted at once by a binary
+    search over the sorted groups - O(N log N).
     :param group_1: list of 1d data points
     :param group_2: list of 1d data points
     :return: optimal classification accuracy (ocr), and classification threshold (th)
     """
-    accuracy_list = []
-    th_list = []
-    all_samples = group_1 + group_2
-    for separator in all_samples:
-        group_1_left = sum([v <= separator + 1e-5 for v in group_1])
-        group_2_right = sum([v > separator + 1e-5 for v in group_2])
-        acc = (group_1_left + group_2_right) / len(all_samples)
-        th_list.append(separator)
-        accuracy_list.append(acc if acc > 0.5 else 1 - acc)
+    all_samples = list(group_1) + list(group_2)
+    sorted_1 = np.sort(np.asarray(group_1, dtype=np.float64))  # nans are sorted last
+    sorted_2 = np.sort(np.asarray(group_2, dtype=np.float64))
+    thresholds = np.asarray(all_samples, dtype=np.float64) + 1e-5
+
+    # nan compares false to anything - nan samples are never counted, and a nan separator counts nothing
+    valid = ~np.isnan(thresholds)
+    group_1_left = np.where(valid, np.searchsorted(sorted_1, thresholds, side='right'), 0)
+    group_2_right = np.where(valid, np.count_nonzero(~np.isnan(sorted_2)) -
+                             np.searchsorted(sorted_2, thresholds, side='right'), 0)
+    acc = (group_1_left + group_2_right) / len(all_samples)
+    accuracy_list = np.where(acc > 0.5, acc, 1 - acc)
 
     best_separator_idx = np.argmax(accuracy_list)
-    oca = accuracy_list[best_separator_idx]
-    th = th_list[best_separator_idx]
+    oca = float(accuracy_list[best_separator_idx])
+    th = all_samples[best_separator_idx]
 
     return oca, th
 
 
+def index_counts(indices, num_points):
+    """
+    Count the number of times each data point is drawn in each row of an index matrix (e.g. bootstrap resamples).
+    :param indices: [B, N'] int array of drawn data points
+    :return: [B, num_points] int array
+    """
+    offsets = num_points * np.arange(len(indices))[:, None]
+    return np.bincount((indices + offsets).reshape(-1), minlength=len(indices) * num_points).reshape(-1, num_points)
+
+
+def weighted_ranks(values, weights):
+    """
+    Ranks (ties get their average rank, as in scipy.stats.rankdata) of data points drawn several times each, for many
+    draws at once - equals the ranks of the expanded draws, without sorting each draw.
+    :param values: [N] data points
+    :param weights: [B, N] number of times each data point is drawn
+    :return: [B, N] rank of each data point within each draw (nan for nan data points)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    is_new = np.ones(len(values), dtype=bool)
+    is_new[1:] = sorted_values[1:] != sorted_values[:-1]
+    group_starts = np.flatnonzero(is_new)
+    group_ends = np.append(group_starts[1:], len(values))
+
+    # weight drawn before each tie group, and within it
+    cum_weights = np.concatenate([np.zeros([len(weights), 1]), np.cumsum(weights[:, order], axis=1)], axis=1)
+    below = cum_weights[:, group_starts]
+    tied = cum_weights[:, group_ends] - below
+    ranks = np.empty(weights.shape)
+    ranks[:, order] = (below + (tied + 1) / 2.)[:, np.cumsum(is_new) - 1]
+    ranks[:, np.isnan(values)] = np.nan
+    return ranks
+
+
+def weighted_pearson(x, y, weights):
+    """
+    Pearson correlation of data points drawn several times each, for many draws at once.
+    :param x: [N] or [B, N] data points
+    :param y: [N] or [B, N] data points
+    :param weights: [B, N] number of times each data point is drawn
+    :return: [B] correlations (nan for constant draws)
+    """
+    weights_sum = weights.sum(axis=1, keepdims=True)
+    x_centered = x - (weights * x).sum(axis=1, keepdims=True) / weights_sum
+    y_centered = y - (weights * y).sum(axis=1, keepdims=True) / weights_sum
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (weights * x_centered * y_centered).sum(axis=1) / np.sqrt(
+            (weights * x_centered ** 2).sum(axis=1) * (weights * y_centered ** 2).sum(axis=1))
+
+
+def batch_optimal_classification_accuracy(samples, is_group_1, weights):
+    """
+    optimal_classification_accuracy of many draws of the same data points at once (e.g. bootstrap resamples, or label
+    permutations), with the same separators and 1e-5 margin. The points are sorted once, and the counts on each side of
+    the separators are read from cumulative weights - O(B * N).
+    :param samples: [N] 1d data points
+    :param is_group_1: [N] or [B, N] bool - True for group_1 points, False for group_2 points
+    :param weights: [B, N] number of times each data point is drawn (0 for points of neither group)
+    :return: [B] optimal classification accuracies
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    weights = np.broadcast_to(weights, np.broadcast(weights, is_group_1).shape)
+    order = np.argsort(samples, kind='stable')  # nans are sorted last
+    zeros = np.zeros([len(weights), 1])
+    cum_weights_1 = np.concatenate([zeros, np.cumsum((weights * is_group_1)[:, order], axis=1)], axis=1)
+    cum_weights_2 = np.concatenate([zeros, np.cumsum((weights * ~is_group_1)[:, order], axis=1)], axis=1)
+
+    # number of (sorted) points <= each separator
+    thresholds = samples + 1e-5
+    num_left = np.searchsorted(samples[order], thresholds, side='right')
+    num_valid = np.count_nonzero(~np.isnan(samples))
+
+    # nan compares false to anything - nan samples are never counted, and a nan separator counts nothing
+    valid = ~np.isnan(thresholds)
+    group_1_left = np.where(valid, cum_weights_1[:, num_left], 0)
+    group_2_right = np.where(valid, cum_weights_2[:, [num_valid]] - cum_weights_2[:, num_left], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc = (group_1_left + group_2_right) / weights.sum(axis=1, keepdims=True)
+    accuracy = np.where(acc > 0.5, acc, 1 - acc)
+    accuracy[weights == 0] = -np.inf  # only the drawn points are separators
+    return np.where((weights > 0).any(axis=1), accuracy.max(axis=1), np.nan)
+
+
 if __name__ == '__main__':
     pass
 